@@ -0,0 +1,142 @@
+import asyncio
+import contextlib
+import time
+from collections import OrderedDict, deque
+
+import metrics
+
+REASON_RATE = 'rate'
+REASON_USER_IN_FLIGHT = 'user_in_flight'
+REASON_QUEUE_FULL = 'queue_full'
+_WINDOW_SECONDS = 60
+
+
+class RejectedException(Exception):
+    reason: str
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Queue:
+    """Пускает к пайплайну не больше max_concurrency запросов; ожидающих обслуживает по кругу между пользователями."""
+    _max_concurrency: int
+    _max_queue: int
+    _user_in_flight: int
+    _user_per_minute: int
+    _running = 0
+    _queued = 0
+    _waiters: OrderedDict[int, deque[asyncio.Future]]
+    _in_flight: dict[int, int]
+    _requests: dict[int, deque[float]]
+    _swept_at: float
+
+    def __init__(self, max_concurrency: int, max_queue: int, user_in_flight: int, user_per_minute: int):
+        self._max_concurrency = max_concurrency
+        self._max_queue = max_queue
+        self._user_in_flight = user_in_flight
+        self._user_per_minute = user_per_minute
+        self._waiters = OrderedDict()
+        self._in_flight = {}
+        self._requests = {}
+        self._swept_at = time.monotonic()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user: int):
+        self._admit(user)
+        self._in_flight[user] = self._in_flight.get(user, 0) + 1
+        try:
+            with metrics.span('queue'):
+                await self._acquire(user)
+            try:
+                yield
+            finally:
+                self._release()
+        finally:
+            if count := self._in_flight[user] - 1:
+                self._in_flight[user] = count
+            else:
+                del self._in_flight[user]
+
+    def running(self) -> int:
+        return self._running
+
+    def queued(self) -> int:
+        return self._queued
+
+    def _admit(self, user: int):
+        now = time.monotonic()
+        if now - self._swept_at > _WINDOW_SECONDS:
+            self._sweep(now)
+
+        requests = self._requests.get(user) or deque()
+        while requests and requests[0] <= now - _WINDOW_SECONDS:
+            requests.popleft()
+        if self._user_per_minute and len(requests) >= self._user_per_minute:
+            self._reject(REASON_RATE)
+        if self._user_in_flight and self._in_flight.get(user, 0) >= self._user_in_flight:
+            self._reject(REASON_USER_IN_FLIGHT)
+        if not self._has_capacity() and self._max_queue and self._queued >= self._max_queue:
+            self._reject(REASON_QUEUE_FULL)
+
+        if self._user_per_minute:
+            requests.append(now)
+            self._requests[user] = requests
+
+    async def _acquire(self, user: int):
+        if self._has_capacity():
+            self._running += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(user, deque()).append(future)
+        self._queued += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._forget(user, future)
+            else:
+                # Слот уже передан этому запросу - отдаём его следующему.
+                self._release()
+            raise
+
+    def _release(self):
+        while self._waiters:
+            user, waiters = next(iter(self._waiters.items()))
+            future = waiters.popleft()
+            self._queued -= 1
+            if waiters:
+                self._waiters.move_to_end(user)
+            else:
+                del self._waiters[user]
+            if not future.done():
+                # Слот переходит ожидающему, счётчик running не меняется.
+                future.set_result(None)
+                return
+
+        self._running -= 1
+
+    def _forget(self, user: int, future: asyncio.Future):
+        if (waiters := self._waiters.get(user)) is None or future not in waiters:
+            return
+
+        waiters.remove(future)
+        self._queued -= 1
+        if not waiters:
+            del self._waiters[user]
+
+    def _has_capacity(self) -> bool:
+        return not self._max_concurrency or (self._running < self._max_concurrency and not self._waiters)
+
+    def _sweep(self, now: float):
+        for user in [user for user, requests in self._requests.items()
+                     if not requests or requests[-1] <= now - _WINDOW_SECONDS]:
+            del self._requests[user]
+        self._swept_at = now
+
+    @staticmethod
+    def _reject(reason: str):
+        metrics.inc('admission_rejected_total', reason=reason)
+        raise RejectedException(reason)
@@ -1,9 +1,18 @@
+import asyncio
+import json
 import log
 import re
+import statistics
+import time
+from collections import deque
+from typing import AsyncIterable, Awaitable, Callable
 
-import requests
+import aiohttp
 
 import cache
+import metrics
+import resilience
+import sessions
 
 
 def normalize_answer(answer: str) -> str:
@@ -15,53 +24,204 @@ def normalize_answer(answer: str) -> str:
     return normalized
 
 
+def is_complete_answer(answer: str) -> bool:
+    """Ответ вида "Название (год)" или строка, оборванная переводом строки."""
+    answer = answer.lstrip()
+    return "\n" in answer or re.search(r"\S.* \(\d{4}\)", answer) is not None
+
+
+class _Backend:
+    _LATENCY_WINDOW = 50
+    _MIN_SAMPLES = 5
+    _ERROR_DECAY = 0.2
+    _ERROR_PENALTY_SECONDS = 10
+
+    base_url: str
+    in_flight = 0
+    _concurrency: int
+    _policy: resilience.Policy
+    _latencies: deque[float]
+    _error_rate = 0.0
+    _semaphore: asyncio.Semaphore | None = None
+    _loop: asyncio.AbstractEventLoop | None = None
+
+    def __init__(self, base_url: str, concurrency: int, policy: resilience.Policy):
+        self.base_url = base_url
+        self._concurrency = max(concurrency, 1)
+        self._policy = policy
+        self._latencies = deque(maxlen=self._LATENCY_WINDOW)
+
+    def rank(self) -> tuple[float, int]:
+        """Ожидаемое время ответа с учётом очереди и доли ошибок: чем меньше, тем лучше."""
+        latency = statistics.median(self._latencies) if self._latencies else 0
+        expected = latency * (1 + self.in_flight / self._concurrency) + self._error_rate * self._ERROR_PENALTY_SECONDS
+        return expected, self.in_flight
+
+    def has_capacity(self) -> bool:
+        return self.in_flight < self._concurrency
+
+    def availability(self) -> tuple[bool, float, int]:
+        """Бэкенд со свободным слотом лучше насыщенного, даже если тот в среднем быстрее."""
+        return not self.has_capacity(), *self.rank()
+
+    def latency_percentile(self, percentile: float) -> float | None:
+        if len(self._latencies) < self._MIN_SAMPLES:
+            return None
+
+        latencies = sorted(self._latencies)
+        return latencies[min(int(len(latencies) * percentile / 100), len(latencies) - 1)]
+
+    async def call(self, func: Callable[[str], Awaitable[str]]) -> str:
+        self.in_flight += 1
+        started_at = time.monotonic()
+        try:
+            async with self._get_semaphore():
+                result = await self._policy.call(func, self.base_url)
+        except Exception:
+            self._error_rate += (1 - self._error_rate) * self._ERROR_DECAY
+            raise
+        finally:
+            self.in_flight -= 1
+
+        self._latencies.append(time.monotonic() - started_at)
+        self._error_rate *= 1 - self._ERROR_DECAY
+        return result
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self._concurrency)
+            self._loop = loop
+
+        return self._semaphore
+
+
 class _Api:
     _ROLE_ASSISTANT = "assistant"
     _ROLE_SYSTEM = "system"
     _ROLE_USER = "user"
+    _STREAM_DATA_PREFIX = b"data:"
+    _STREAM_DONE = b"[DONE]"
 
-    _base_url: str
+    _backends: list[_Backend]
+    _hedge_percentile: float
     _model: str
     _temperature: float
     _max_tokens: int
     _stream: bool
     _storage: cache.Storage
+    _pool: sessions.Pool
 
     def __init__(self,
-                 base_url: str,
+                 base_urls: list[str],
                  model: str,
                  temperature: float,
                  max_tokens: int,
                  stream: bool,
-                 storage: cache.Storage):
-        self._base_url = base_url
+                 storage: cache.Storage,
+                 pool: sessions.Pool,
+                 policy: resilience.Policy,
+                 concurrency: int | list[int] = 1,
+                 hedge_percentile: float = 0):
+        # Лимит задаётся для каждого адреса по порядку; последний действует на оставшиеся.
+        limits = concurrency if isinstance(concurrency, list) else [concurrency]
+        self._backends = [_Backend(base_url, limits[min(index, len(limits) - 1)], policy.fork(f'ai {base_url}'))
+                          for index, base_url in enumerate(base_urls)]
+        self._hedge_percentile = hedge_percentile
         self._model = model
         self._temperature = temperature
         self._max_tokens = max_tokens
         self._stream = stream
         self._storage = storage
+        self._pool = pool
 
-    def answer(self, prompt: str, system_prompt: str = None) -> str:
+    async def answer(self, prompt: str, system_prompt: str = None) -> str:
         @cache.with_cache(self._storage)
-        def execute(_prompt) -> str:
+        async def execute(_prompt) -> str:
             try:
-                request = self._build_request(_prompt, system_prompt)
-                response = self._execute_request(request)
+                return await self._route(self._build_request(_prompt, system_prompt))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise AssistantException(str(e) or e.__class__.__name__, AssistantException.CODE_MODEL_UNAVAILABLE)
 
-                return self._parse_response(response)
-            except requests.exceptions.ConnectionError as e:
-                raise AssistantException(str(e), AssistantException.CODE_MODEL_UNAVAILABLE)
-
-        return execute(prompt)
+        return await execute(prompt)
 
     def shutdown(self):
         self._storage.archive()
 
-    def _execute_request(self, json_data: dict) -> dict:
-        return (requests.post(f"{self._base_url}/v1/chat/completions",
-                              headers={"Content-Type": "application/json"},
-                              json=json_data)
-                .json())
+    async def close(self):
+        await self._pool.close()
+
+    async def _route(self, request: dict) -> str:
+        """Запрос к самому быстрому бэкенду; хедж на следующий после перцентиля задержки, переход при ошибке."""
+        backends = sorted(self._backends, key=_Backend.availability)
+        primary, standby = backends[0], backends[1:]
+        hedge_after = primary.latency_percentile(self._hedge_percentile) if self._hedge_percentile else None
+        pending = {asyncio.ensure_future(primary.call(lambda base_url: self._execute(base_url, request)))}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+
+                hedge = not done and hedge_after is not None and standby and standby[0].has_capacity()
+                hedge_after = None
+                if hedge or (not pending and standby):
+                    standby.sort(key=_Backend.availability)
+                    backend = standby.pop(0)
+                    log.info('ai: hedge' if hedge else 'ai: failover', backend.base_url)
+                    pending.add(asyncio.ensure_future(backend.call(lambda base_url: self._execute(base_url, request))))
+
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _execute(self, base_url: str, request: dict) -> str:
+        if self._stream:
+            return await self._execute_stream_request(base_url, request)
+
+        return self._parse_response(await self._execute_request(base_url, request))
+
+    async def _execute_request(self, base_url: str, json_data: dict) -> dict:
+        async with self._pool.session().post(f"{base_url}/v1/chat/completions",
+                                             headers={"Content-Type": "application/json"},
+                                             json=json_data) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def _execute_stream_request(self, base_url: str, json_data: dict) -> str:
+        async with self._pool.session().post(f"{base_url}/v1/chat/completions",
+                                             headers={"Content-Type": "application/json",
+                                                      "Accept": "text/event-stream"},
+                                             json=json_data) as response:
+            response.raise_for_status()
+            answer = await self._read_stream(response.content)
+            if not response.content.at_eof():
+                # Обрываем генерацию: соединение закрывается, и сервер освобождает слот модели.
+                response.close()
+
+            return answer
+
+    @classmethod
+    async def _read_stream(cls, lines: AsyncIterable[bytes]) -> str:
+        answer = ""
+        async for line in lines:
+            line = line.strip()
+            if not line.startswith(cls._STREAM_DATA_PREFIX):
+                continue
+
+            data = line[len(cls._STREAM_DATA_PREFIX):].strip()
+            if data == cls._STREAM_DONE:
+                break
+
+            answer += cls._parse_stream_chunk(json.loads(data))
+            if is_complete_answer(answer):
+                break
+
+        return answer.strip().split("\n")[0]
 
     def _build_request(self, prompt: str, system_prompt: str = None) -> dict:
         request = {
@@ -83,6 +243,10 @@ class _Api:
     def _parse_response(response: dict) -> str:
         return response.get("choices", [{}])[0].get("message", {}).get("content", "")
 
+    @staticmethod
+    def _parse_stream_chunk(chunk: dict) -> str:
+        return (chunk.get("choices") or [{}])[0].get("delta", {}).get("content") or ""
+
     @staticmethod
     def _build_message(role: str, content: str) -> dict:
         return {
@@ -96,26 +260,35 @@ class Assistant:
 
     def __init__(self,
                  system_prompt: str,
-                 base_url: str,
+                 base_urls: list[str],
                  model: str,
                  temperature: float,
                  max_tokens: int,
                  stream: bool,
                  storage: cache.Storage,
+                 pool: sessions.Pool,
+                 policy: resilience.Policy,
+                 concurrency: int = 1,
+                 hedge_percentile: float = 0,
                  ):
         self._system_prompt = system_prompt
         self._api = _Api(
-            base_url,
+            base_urls,
             model,
             temperature,
             max_tokens,
             stream,
-            storage
+            storage,
+            pool,
+            policy,
+            concurrency,
+            hedge_percentile
         )
 
-    def find_movie_by_summary(self, unescape_json: str, _id: str, post_process: bool = True) -> str | None:
+    @metrics.timed('ai')
+    async def find_movie_by_summary(self, unescape_json: str, _id: str, post_process: bool = True) -> str | None:
         try:
-            answer = self._api.answer(f'```{unescape_json}```', self._system_prompt)
+            answer = await self._api.answer(f'```{unescape_json}```', self._system_prompt)
             if post_process:
                 return normalize_answer(answer)
 
@@ -127,6 +300,9 @@ class Assistant:
     def shutdown(self):
         self._api.shutdown()
 
+    async def close(self):
+        await self._api.close()
+
 
 class AssistantException(Exception):
     CODE_MODEL_UNAVAILABLE = 410
@@ -0,0 +1,32 @@
+from dataclasses import dataclass
+
+import kinopoisk
+import messages
+
+
+@dataclass
+class Answer:
+    OUTCOME_APPROVED = "approved"
+    OUTCOME_HALF_APPROVED = "half_approved"
+    OUTCOME_NOT_APPROVED = "not_approved"
+
+    def __init__(self, outcome: str, assistant_movie: str, movie: kinopoisk.Movie | None, score: int,
+                 provider_link: str | None = None):
+        self.outcome = outcome
+        self.assistant_movie = assistant_movie
+        self.movie = movie
+        self.score = score
+        self.provider_link = provider_link
+
+    def render(self) -> tuple[str | None, str | None]:
+        if self.outcome == self.OUTCOME_NOT_APPROVED:
+            return None, messages.not_approved_movie_msg(self.assistant_movie)
+
+        if self.outcome == self.OUTCOME_HALF_APPROVED:
+            return None, messages.half_approved_movie_msg(self.assistant_movie, self.movie.name_with_year())
+
+        return messages.approved_movie(self.movie.name_with_year(), self.movie.link(), self.provider_link), None
+
+
+def build_key(video_id: str, provider: str | None) -> str:
+    return f'{video_id}_{provider or ""}'
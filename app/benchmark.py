@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+from dotenv import load_dotenv
+
+import standins
+
+_DOTENV_PATH = '.env'
+# Значения, без которых config не соберётся, если .env нет (например, в CI).
+_DEFAULTS = {
+    'YOUTUBE_API_KEY': 'standin',
+    'KINOPOISK_API_KEY': 'standin',
+    'AI_MODEL': 'standin',
+    'AI_TEMPERATURE': '0.2',
+    'AI_MAX_TOKENS': '20',
+    'AI_CACHE_TTL_SECONDS': '3600',
+    'KINOPOISK_CACHE_TTL_SECONDS': '86400',
+    'KARELIA_PRO_CACHE_TTL_SECONDS': '86400',
+    'KARELIA_PRO_TIMEOUT_SECONDS': '1',
+    'MOVIE_NOT_APPROVE_THRESHOLD': '50',
+    'MOVIE_HALF_APPROVE_THRESHOLD': '88',
+}
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """Перцентиль по ближайшему рангу."""
+    if not values:
+        return 0
+
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(len(values) * percent / 100 + 0.5) - 1))]
+
+
+def build_report(latencies: list[float], errors: int, duration: float, calls: dict[str, int], concurrency: int) -> str:
+    requests = len(latencies)
+    per_request = ' '.join(f'{upstream}={calls.get(upstream, 0) / max(requests, 1):.2f}'
+                           for upstream in standins.UPSTREAMS)
+    return '\n'.join([
+        f'requests={requests} concurrency={concurrency} errors={errors} duration={duration:.2f}s '
+        f'throughput={requests / duration if duration else 0:.1f} rps',
+        f'latency p50={percentile(latencies, 50):.3f}s p95={percentile(latencies, 95):.3f}s '
+        f'p99={percentile(latencies, 99):.3f}s max={max(latencies, default=0):.3f}s',
+        f'upstream calls per request: {per_request}',
+    ])
+
+
+def configure(base_url: str, storage_path: str, unlimited: bool):
+    load_dotenv(_DOTENV_PATH)
+    os.environ.update({
+        'STORAGE_PATH': storage_path,
+        'YOUTUBE_API_BASE_URL': base_url + standins.YOUTUBE_PREFIX,
+        'AI_BASE_URL': base_url,
+        'AI_BASE_URLS': '',
+        'KINOPOISK_API_BASE_URL': base_url,
+        'KARELIA_PRO_BASE_URL': base_url.removeprefix('http://'),
+        'METRICS_PORT': '0',
+    })
+    if unlimited:
+        os.environ.update({'YOUTUBE_RATE_PER_SECOND': '0', 'KARELIA_PRO_RATE_PER_SECOND': '0'})
+    for name, value in _DEFAULTS.items():
+        os.environ.setdefault(name, value)
+
+
+def _read_links(args: argparse.Namespace) -> list[str]:
+    if args.links:
+        with open(args.links, encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip()]
+
+    return [f'https://youtu.be/bench{i}' for i in range(args.videos)]
+
+
+async def _run(args: argparse.Namespace):
+    stand_ins = standins.StandIns(args.fixtures, standins.parse_upstream_values(args.latency), args.jitter)
+    runner, base_url = await stand_ins.start()
+    with tempfile.TemporaryDirectory(prefix='benchmark-storage-') as storage_path:
+        configure(base_url, args.storage or storage_path, args.unlimited)
+        # Конфигурация читается при импорте, поэтому core импортируется только после подмены окружения.
+        import core
+        import karelia_pro
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+
+        links = _read_links(args)
+        provider = karelia_pro.PROVIDER if args.provider else None
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def request(link: str) -> tuple[float, bool]:
+            async with semaphore:
+                started_at = time.perf_counter()
+                _, error = await core.prepare_answer(link, 'benchmark', str(uuid.uuid4()), provider)
+                return time.perf_counter() - started_at, error is not None
+
+        try:
+            for _round in range(1, args.rounds + 1):
+                stand_ins.calls.clear()
+                started_at = time.perf_counter()
+                results = await asyncio.gather(*[request(links[i % len(links)]) for i in range(args.requests)])
+                duration = time.perf_counter() - started_at
+                print(f'# round {_round}')
+                print(build_report([latency for latency, _ in results], sum(error for _, error in results), duration,
+                                   stand_ins.calls, args.concurrency))
+        finally:
+            await core.drain(args.drain_timeout)
+            await core.close()
+            core.shutdown()
+            await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон core.prepare_answer на локальных подменах.')
+    parser.add_argument('--requests', type=int, default=100, help='запросов за раунд')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--videos', type=int, default=20, help='разных синтетических видео')
+    parser.add_argument('--links', help='файл со ссылками, по одной в строке (для записанных фикстур)')
+    parser.add_argument('--fixtures', help='каталог фикстур для воспроизведения')
+    parser.add_argument('--latency', default='youtube=0.05,ai=0.5,kinopoisk=0.1,karelia_pro=0.1',
+                        help='задержка по апстримам в секундах')
+    parser.add_argument('--jitter', type=float, default=0.2, help='разброс задержки, доля от 0 до 1')
+    parser.add_argument('--rounds', type=int, default=2, help='раунды на одном хранилище: холодный кэш, затем тёплый')
+    parser.add_argument('--storage', help='каталог хранилища вместо временного')
+    parser.add_argument('--provider', action='store_true', help='искать ссылку у провайдера Karelia Pro')
+    parser.add_argument('--unlimited', action='store_true', help='снять лимиты частоты YouTube и Karelia Pro')
+    parser.add_argument('--drain-timeout', type=float, default=10, help='ожидание фоновых запросов в конце, секунд')
+    parser.add_argument('--verbose', action='store_true')
+    asyncio.run(_run(parser.parse_args()))
@@ -1,11 +1,21 @@
+import asyncio
 import hashlib
+import inspect
+import threading
 import time
-from typing import Dict
+from collections import OrderedDict
+from typing import Callable
 
 import files
+import log
+import metrics
+import persistence
 import serialize
 
 
+_CORRUPT_SUFFIX = 'corrupt'
+
+
 def sha256_hash(input_string) -> str:
     return hashlib.sha256(input_string.encode('utf-8')).hexdigest()
 
@@ -32,10 +42,14 @@ def _key_by_args(*args, **kwargs) -> str:
 class _StorageItem:
     _data = None
     _expired_at = None
+    size = 0
 
-    def __init__(self, data, ttl=0):
+    def __init__(self, data, ttl=0, size=0, expired_at=None):
         self._data = data
-        if ttl != 0:
+        self.size = size
+        if expired_at:
+            self._expired_at = expired_at
+        elif ttl != 0:
             self._expired_at = time.time() + ttl
 
     def is_expired(self) -> bool:
@@ -46,58 +60,293 @@ class _StorageItem:
     def extract(self):
         return self._data
 
+    def expired_at(self) -> float | None:
+        return self._expired_at
+
+
+class _Failure:
+    error: BaseException
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+    def error_to_raise(self) -> BaseException:
+        """Один экземпляр поднимается на каждом попадании - без сброса его __traceback__ рос бы бесконечно."""
+        return self.error.with_traceback(None)
+
 
 class Storage:
-    _vault: Dict[str, _StorageItem] = None
+    _vault: OrderedDict[str, _StorageItem] = None
     _ttl = 0
+    _max_entries = 0
+    _max_bytes = 0
+    _bytes = 0
+    _sweep_interval = 0
+    _swept_at = 0
+    _backend: persistence.SqliteBackend | None = None
+    _restoring: threading.Thread | None = None
+    _sweeper: asyncio.Task | None = None
+    _in_flight: dict[str, asyncio.Future] = None
+    _negative_ttls: dict[type, int] = None
+    _negative_filter: Callable[[BaseException], bool] | None = None
+    _empty_ttl = 0
+    _local_ttl = 0
 
-    def __init__(self, default_key_timeout=0, name: str = 'storage'):
-        self._vault = {}
+    def __init__(self, default_key_timeout=0, name: str = 'storage', max_entries=0, max_bytes=0, sweep_interval=60,
+                 backend: persistence.SqliteBackend = None, negative_ttls: dict[type, int] = None, empty_ttl=0,
+                 local_ttl=0, negative_filter: Callable[[BaseException], bool] = None):
+        self._vault = OrderedDict()
         self._ttl = default_key_timeout
         self.name = name
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._sweep_interval = sweep_interval
+        self._swept_at = time.time()
+        self._backend = backend
+        self._in_flight = {}
+        self._negative_ttls = negative_ttls or {}
+        self._negative_filter = negative_filter
+        self._empty_ttl = empty_ttl
+        self._local_ttl = local_ttl
 
     def put(self, key, data, ttl=0):
         if ttl == 0:
             ttl = self._ttl
-        self._vault[key] = _StorageItem(data, ttl)
+        payload = serialize.serialize_bytes(data) if self._max_bytes or self._backend else b''
+        item = _StorageItem(data, ttl, len(payload))
+        self._keep(key, self._local(item))
+        if self._backend:
+            self._backend.write(key, payload, item.expired_at())
+
+        # Без фоновой очистки (синхронное использование) просроченное чистится при записи.
+        if self._sweeper is None and time.time() - self._swept_at > self._sweep_interval:
+            self.cleanup()
+
+    def put_failure(self, key, error: BaseException):
+        """Запоминает ошибку только в памяти: исключения не обязаны сериализоваться."""
+        if self._negative_filter is not None and not self._negative_filter(error):
+            return
+
+        for error_class, ttl in self._negative_ttls.items():
+            if isinstance(error, error_class):
+                if ttl:
+                    self._keep(key, _StorageItem(_Failure(error), ttl))
+                return
+
+    def put_result(self, key, data):
+        self.put(key, data, self._empty_ttl if not data else 0)
 
     def get(self, key, default=None):
-        item = self._vault.get(key, None)
-        if isinstance(item, _StorageItem):
-            if not item.is_expired():
-                return item.extract()
-        return default
+        if (item := self._memory_hit(key)) is not None:
+            return item.extract()
+
+        return self._disk_hit(key, self._backend.read(key) if self._backend else None, default)
+
+    async def get_async(self, key, default=None):
+        """Как get, но чтение с диска уходит в поток и не держит event loop."""
+        if (item := self._memory_hit(key)) is not None:
+            return item.extract()
+
+        return self._disk_hit(key, await asyncio.to_thread(self._backend.read, key) if self._backend else None,
+                              default)
+
+    def in_flight(self, key, factory) -> asyncio.Future:
+        if (task := self._in_flight.get(key)) is None:
+            task = asyncio.ensure_future(factory())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _task: self._land(key, _task))
+
+        return task
+
+    def delete(self, key):
+        self._remove(key)
+        if self._backend:
+            self._backend.delete(key)
+
+    def __len__(self):
+        return len(self._vault)
+
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def flush(self):
+        if self._backend:
+            self._backend.flush()
 
     def archive(self):
-        self.cleanup()
-        files.save_file(files.build_storage_path(self.name), serialize.serialize_bytes(self))
+        if self._backend:
+            self._backend.compact()
+            self._backend.close()
 
     @staticmethod
-    def restore(default_key_timeout=0, name: str = 'storage'):
-        storage = serialize.deserialize_bytes(files.read_file(files.build_storage_path(name)))
-        if storage is not None:
-            storage._ttl = default_key_timeout
-            storage.cleanup()
-            return storage
+    def restore(default_key_timeout=0, name: str = 'storage', max_entries=0, max_bytes=0, sweep_interval=60,
+                negative_ttls: dict[type, int] = None, empty_ttl=0, local_ttl=0,
+                negative_filter: Callable[[BaseException], bool] = None):
+        started_at = time.perf_counter()
+        backend = persistence.SqliteBackend(files.build_storage_path(name, files.EXTENSION_SQLITE))
+        storage = Storage(default_key_timeout, name, max_entries, max_bytes, sweep_interval, backend,
+                          negative_ttls, empty_ttl, local_ttl, negative_filter)
+
+        legacy_path = files.build_storage_path(name)
+        if files.exists(legacy_path):
+            storage._restoring = threading.Thread(target=_migrate_legacy_archive, args=(backend, legacy_path, name),
+                                                  name=f'restore:{name}', daemon=True)
+            storage._restoring.start()
+
+        log.info(f'storage {name} opened in {(time.perf_counter() - started_at) * 1000:.1f} ms')
+        return storage
+
+    def start_sweeping(self):
+        """Чистит просроченное задачей текущего event loop - и тогда, когда записей нет."""
+        if self._sweeper is None and self._sweep_interval:
+            self._sweeper = asyncio.ensure_future(self._sweep_periodically())
 
-        return Storage(default_key_timeout=default_key_timeout, name=name)
+    async def stop_sweeping(self):
+        if self._sweeper is None:
+            return
+
+        self._sweeper.cancel()
+        try:
+            await self._sweeper
+        except asyncio.CancelledError:
+            pass
+        self._sweeper = None
+
+    def wait_restored(self, timeout: float = None):
+        if self._restoring is not None:
+            self._restoring.join(timeout)
 
     def cleanup(self):
         for key in [k for k, v in self._vault.items() if v.is_expired()]:
-            del self._vault[key]
+            self._remove(key)
+        self._swept_at = time.time()
+        if self._backend:
+            self._backend.compact_in_background()
+
+    async def _sweep_periodically(self):
+        while True:
+            await asyncio.sleep(self._sweep_interval)
+            try:
+                self.cleanup()
+            except Exception as e:
+                log.exception(e, self.name)
+
+    def _land(self, key, task: asyncio.Future):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            task.exception()
+
+    def _local(self, item: _StorageItem) -> _StorageItem:
+        """Хранилище общее с другими процессами: в памяти запись живёт не дольше local_ttl, чтобы видеть их удаления."""
+        if not self._local_ttl:
+            return item
+
+        local_expired_at = time.time() + self._local_ttl
+        if item.expired_at() is not None and item.expired_at() <= local_expired_at:
+            return item
+
+        return _StorageItem(item.extract(), size=item.size, expired_at=local_expired_at)
+
+    def _memory_hit(self, key) -> _StorageItem | None:
+        if (item := self._vault.get(key, None)) is None:
+            return None
+        if item.is_expired():
+            self._remove(key)
+            return None
+
+        self._vault.move_to_end(key)
+        metrics.inc('cache_requests_total', storage=self.name, result='hit')
+        return item
+
+    def _disk_hit(self, key, stored: tuple[bytes, float | None] | None, default):
+        if not stored:
+            metrics.inc('cache_requests_total', storage=self.name, result='miss')
+            return default
+
+        payload, expired_at = stored
+        item = _StorageItem(serialize.deserialize_bytes(payload), size=len(payload), expired_at=expired_at)
+        self._keep(key, self._local(item))
+        metrics.inc('cache_requests_total', storage=self.name, result='disk_hit')
+        return item.extract()
+
+    def _keep(self, key, item: _StorageItem):
+        self._remove(key)
+        self._vault[key] = item
+        self._bytes += item.size
+        self._evict()
+
+    def _remove(self, key):
+        if (item := self._vault.pop(key, None)) is not None:
+            self._bytes -= item.size
+
+    def _evict(self):
+        while self._vault and (
+                (self._max_entries and len(self._vault) > self._max_entries) or
+                (self._max_bytes and self._bytes > self._max_bytes)):
+            self._remove(next(iter(self._vault)))
+
+
+def _migrate_legacy_archive(backend: persistence.SqliteBackend, legacy_path: str, name: str):
+    started_at = time.perf_counter()
+    try:
+        archived = serialize.deserialize_bytes(files.read_file(legacy_path))
+        rows = [(key, serialize.serialize_bytes(item.extract()), item.expired_at())
+                for key, item in archived._vault.items() if not item.is_expired()]
+    except Exception as e:
+        # Битый архив откладываем в сторону, иначе перенос падал бы при каждом запуске.
+        log.exception(e, legacy_path)
+        files.move_file(legacy_path, f'{legacy_path}.{_CORRUPT_SUFFIX}')
+        return
+
+    # Записи, сделанные после старта, свежее архива - их не перезаписываем.
+    backend.write_many(rows, replace=False)
+    files.remove_file(legacy_path)
+
+    log.info(f'storage {name} restored {len(rows)} legacy entries in '
+             f'{(time.perf_counter() - started_at) * 1000:.1f} ms')
 
 
 def with_cache(storage: Storage):
     def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            async def async_wrapper(*args, **kwargs):
+                key = sha256_hash(_key_by_args(*args, **kwargs))
+                cached = await storage.get_async(key)
+
+                if isinstance(cached, _Failure):
+                    raise cached.error_to_raise()
+                if cached is not None:
+                    return cached
+
+                async def compute():
+                    try:
+                        data = await func(*args, **kwargs)
+                    except Exception as e:
+                        storage.put_failure(key, e)
+                        raise
+                    storage.put_result(key, data)
+                    return data
+
+                return await asyncio.shield(storage.in_flight(key, compute))
+
+            return async_wrapper
+
         def wrapper(*args, **kwargs):
             key = sha256_hash(_key_by_args(*args, **kwargs))
             cached = storage.get(key)
 
+            if isinstance(cached, _Failure):
+                raise cached.error_to_raise()
             if cached is not None:
                 return cached
 
-            data = func(*args, **kwargs)
-            storage.put(key, data)
+            try:
+                data = func(*args, **kwargs)
+            except Exception as e:
+                storage.put_failure(key, e)
+                raise
+            storage.put_result(key, data)
             return data
 
         return wrapper
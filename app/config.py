@@ -25,20 +25,62 @@ def _list(name: str, default=None) -> list[str]:
     return default
 
 
+STORAGE_PATH = _get("STORAGE_PATH", "/app/storage").rstrip("/")
+
+HTTP_POOL_SIZE = _get("HTTP_POOL_SIZE", 20, int)
+HTTP_CONNECT_TIMEOUT_SECONDS = _get("HTTP_CONNECT_TIMEOUT_SECONDS", 5, float)
+HTTP_READ_TIMEOUT_SECONDS = _get("HTTP_READ_TIMEOUT_SECONDS", 30, float)
+HTTP_KEEPALIVE_SECONDS = _get("HTTP_KEEPALIVE_SECONDS", 60, float)
+HTTP_TOTAL_TIMEOUT_SECONDS = _get("HTTP_TOTAL_TIMEOUT_SECONDS", 60, float)
+HTTP_RETRIES = _get("HTTP_RETRIES", 2, int)
+HTTP_RETRY_BACKOFF_SECONDS = _get("HTTP_RETRY_BACKOFF_SECONDS", 0.2, float)
+HTTP_RETRY_MAX_BACKOFF_SECONDS = _get("HTTP_RETRY_MAX_BACKOFF_SECONDS", 2, float)
+HTTP_BREAKER_THRESHOLD = _get("HTTP_BREAKER_THRESHOLD", 5, int)
+HTTP_BREAKER_RESET_SECONDS = _get("HTTP_BREAKER_RESET_SECONDS", 30, float)
+
+METRICS_HOST = _get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = _get("METRICS_PORT", 0, int)
+METRICS_TIMING_LOG = bool(_get("METRICS_TIMING_LOG", 0, int))
+
+CACHE_MAX_ENTRIES = _get("CACHE_MAX_ENTRIES", 10000, int)
+CACHE_MAX_BYTES = _get("CACHE_MAX_BYTES", 64 * 1024 * 1024, int)
+CACHE_SWEEP_INTERVAL_SECONDS = _get("CACHE_SWEEP_INTERVAL_SECONDS", 300, int)
+CACHE_ERROR_TTL_SECONDS = _get("CACHE_ERROR_TTL_SECONDS", 300, int)
+CACHE_NOT_FOUND_TTL_SECONDS = _get("CACHE_NOT_FOUND_TTL_SECONDS", 3600, int)
+
 YOUTUBE_API_KEY = _get("YOUTUBE_API_KEY")
+YOUTUBE_API_BASE_URL = _get("YOUTUBE_API_BASE_URL", "https://www.googleapis.com/youtube/v3").rstrip("/")
 YOUTUBE_MAX_COMMENTS = _get("YOUTUBE_MAX_COMMENTS", 20, int)
 YOUTUBE_TIMEOUT_SECONDS = _get("YOUTUBE_TIMEOUT_SECONDS", 1, float)
+YOUTUBE_RATE_PER_SECOND = _get("YOUTUBE_RATE_PER_SECOND", 1 / YOUTUBE_TIMEOUT_SECONDS, float)
+YOUTUBE_RATE_BURST = _get("YOUTUBE_RATE_BURST", 1, int)
 YOUTUBE_CACHE_TTL_SECONDS = _get("YOUTUBE_CACHE_TTL_SECONDS", 86400, int)
 
 AI_SYSTEM_PROMPT = _get("AI_SYSTEM_PROMPT")
 AI_BASE_URL = _get("AI_BASE_URL", "").rstrip("/")
+AI_BASE_URLS = [url.rstrip("/") for url in _list("AI_BASE_URLS")] or [AI_BASE_URL]
+AI_BACKEND_CONCURRENCY = [int(limit) for limit in _list("AI_BACKEND_CONCURRENCY", "2")]
+AI_HEDGE_PERCENTILE = _get("AI_HEDGE_PERCENTILE", 0, float)
 AI_MODEL = _get("AI_MODEL")
 AI_TEMPERATURE = _get("AI_TEMPERATURE", _type=float)
 AI_MAX_TOKENS = _get("AI_MAX_TOKENS", _type=int)
 AI_STREAM = bool(_get("AI_STREAM", _type=int))
 AI_CACHE_TTL_SECONDS = _get("AI_CACHE_TTL_SECONDS", _type=int)
+AI_PROMPT_MAX_CHARS = _get("AI_PROMPT_MAX_CHARS", 4000, int)
+AI_POOL_SIZE = _get("AI_POOL_SIZE", HTTP_POOL_SIZE, int)
+AI_READ_TIMEOUT_SECONDS = _get("AI_READ_TIMEOUT_SECONDS", 120, float)
+AI_TOTAL_TIMEOUT_SECONDS = _get("AI_TOTAL_TIMEOUT_SECONDS", 300, float)
 
 TELEGRAM_BOT_TOKEN = _get("TELEGRAM_BOT_TOKEN")
+TELEGRAM_BOT_ADMINS = set(_get('TELEGRAM_BOT_ADMINS', '').split(','))
+TELEGRAM_BOT_MODE = _get("TELEGRAM_BOT_MODE", "polling")
+TELEGRAM_WEBHOOK_HOST = _get("TELEGRAM_WEBHOOK_HOST", "0.0.0.0")
+TELEGRAM_WEBHOOK_PORT = _get("TELEGRAM_WEBHOOK_PORT", 8080, int)
+TELEGRAM_WEBHOOK_PATH = _get("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+TELEGRAM_WEBHOOK_URL = _get("TELEGRAM_WEBHOOK_URL")
+TELEGRAM_WEBHOOK_SECRET = _get("TELEGRAM_WEBHOOK_SECRET")
+TELEGRAM_WEBHOOK_MAX_IN_FLIGHT = _get("TELEGRAM_WEBHOOK_MAX_IN_FLIGHT", 100, int)
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = _get("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", 40, int)
 TELEGRAM_BOT_START_MESSAGE = _get("TELEGRAM_BOT_START_MESSAGE", "hello_message")
 TELEGRAM_BOT_ERROR_NOT_FOUND_VIDEO_ID = _get("TELEGRAM_BOT_ERROR_NOT_FOUND_VIDEO_ID", "video_id_not_found_message")
 TELEGRAM_BOT_ERROR_NOT_FOUND_VIDEO_BY_ID = _get("TELEGRAM_BOT_ERROR_NOT_FOUND_VIDEO_BY_ID", "video_not_found_message")
@@ -47,13 +89,32 @@ TELEGRAM_BOT_ERROR_NOT_APPPROVED_MOVIE_TEMPLATE = _get("TELEGRAM_BOT_ERROR_NOT_A
                                                        "movie_not_approved_template")
 TELEGRAM_BOT_ERROR_HALF_APPPROVED_MOVIE_TEMPLATE = _get("TELEGRAM_BOT_ERROR_HALF_APPPROVED_MOVIE_TEMPLATE",
                                                         "movie_half_approved_template")
+TELEGRAM_BOT_ANSWER_FORGOTTEN = _get("TELEGRAM_BOT_ANSWER_FORGOTTEN", "answer_forgotten_message")
+TELEGRAM_BOT_ERROR_BUSY = _get("TELEGRAM_BOT_ERROR_BUSY", "busy_message")
+
+ADMISSION_MAX_CONCURRENCY = _get("ADMISSION_MAX_CONCURRENCY", 32, int)
+ADMISSION_MAX_QUEUE = _get("ADMISSION_MAX_QUEUE", 100, int)
+ADMISSION_USER_IN_FLIGHT = _get("ADMISSION_USER_IN_FLIGHT", 2, int)
+ADMISSION_USER_PER_MINUTE = _get("ADMISSION_USER_PER_MINUTE", 10, int)
 
 KINOPOISK_API_KEY = _get("KINOPOISK_API_KEY")
 KINOPOISK_API_BASE_URL = _get("KINOPOISK_API_BASE_URL", "").rstrip("/")
 KINOPOISK_CACHE_TTL_SECONDS = _get("KINOPOISK_CACHE_TTL_SECONDS", _type=int)
 
+ANSWER_CACHE_TTL_SECONDS = _get('ANSWER_CACHE_TTL_SECONDS', 604800, int)
+ANSWER_NOT_APPROVED_CACHE_TTL_SECONDS = _get('ANSWER_NOT_APPROVED_CACHE_TTL_SECONDS', 600, int)
+
 MOVIE_NOT_APPROVE_THRESHOLD = _get('MOVIE_NOT_APPROVE_THRESHOLD', _type=int)
 MOVIE_HALF_APPROVE_THRESHOLD = _get('MOVIE_HALF_APPROVE_THRESHOLD', _type=int)
+TITLES_INDEX_APPROVE_THRESHOLD = _get('TITLES_INDEX_APPROVE_THRESHOLD', 95, int)
+
+HEURISTICS_ENABLED = bool(_get('HEURISTICS_ENABLED', 1, int))
+HEURISTICS_MAX_CANDIDATES = _get('HEURISTICS_MAX_CANDIDATES', 3, int)
+HEURISTICS_TIMEOUT_SECONDS = _get('HEURISTICS_TIMEOUT_SECONDS', 1.5, float)
+
+CORE_SPECULATIVE = bool(_get('CORE_SPECULATIVE', _type=int))
+CORE_WORKERS = _get('CORE_WORKERS', 0, int)
+CORE_WORKERS_LOCAL_CACHE_TTL_SECONDS = _get('CORE_WORKERS_LOCAL_CACHE_TTL_SECONDS', 5, int)
 
 CORE_MESSAGES_AI_PLACEHOLDER = _get('CORE_MESSAGES_AI_PLACEHOLDER')
 CORE_MESSAGES_APPROVER_PLACEHOLDER = _get('CORE_MESSAGES_APPROVER_PLACEHOLDER')
@@ -61,4 +122,7 @@ CORE_MESSAGES_APPROVER_PLACEHOLDER = _get('CORE_MESSAGES_APPROVER_PLACEHOLDER')
 KARELIA_PRO_USERS = set(_get('KARELIA_PRO_USERS', '').split(','))
 KARELIA_PRO_CACHE_TTL_SECONDS = _get('KARELIA_PRO_CACHE_TTL_SECONDS', _type=int)
 KARELIA_PRO_TIMEOUT_SECONDS = _get('KARELIA_PRO_TIMEOUT_SECONDS', _type=int)
+KARELIA_PRO_RATE_PER_SECOND = _get('KARELIA_PRO_RATE_PER_SECOND',
+                                   1 / KARELIA_PRO_TIMEOUT_SECONDS if KARELIA_PRO_TIMEOUT_SECONDS else 0, float)
+KARELIA_PRO_RATE_BURST = _get('KARELIA_PRO_RATE_BURST', 1, int)
 KARELIA_PRO_BASE_URL = _get('KARELIA_PRO_BASE_URL')
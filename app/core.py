@@ -1,62 +1,164 @@
+import asyncio
 import sys
 import logging
 
+import aiohttp
+from aiohttp import web
+
+import admission
 import ai
+import answers
 import cache
 import config
+import heuristics
 import kinopoisk
 import log
 import matcher
 import messages
+import metrics
+import resilience
+import sessions
 import strings
 import throttling
+import titles
+import workers
 import youtube
 import karelia_pro
 
+
+def _build_pool(size: int = config.HTTP_POOL_SIZE, read_timeout: float = config.HTTP_READ_TIMEOUT_SECONDS,
+                total_timeout: float = config.HTTP_TOTAL_TIMEOUT_SECONDS) -> sessions.Pool:
+    return sessions.Pool(size, config.HTTP_CONNECT_TIMEOUT_SECONDS, read_timeout, config.HTTP_KEEPALIVE_SECONDS,
+                         total_timeout)
+
+
+def _build_policy(name: str) -> resilience.Policy:
+    return resilience.Policy(name, config.HTTP_RETRIES, config.HTTP_RETRY_BACKOFF_SECONDS,
+                             config.HTTP_RETRY_MAX_BACKOFF_SECONDS, config.HTTP_BREAKER_THRESHOLD,
+                             config.HTTP_BREAKER_RESET_SECONDS)
+
+
+_NEGATIVE_CACHE_TTLS = {
+    kinopoisk.MovieDataNotFoundException: config.CACHE_NOT_FOUND_TTL_SECONDS,
+    aiohttp.ClientResponseError: config.CACHE_ERROR_TTL_SECONDS,
+}
+_DEFINITIVE_STATUSES = {404}
+
+
+def _is_definitive_failure(error: BaseException) -> bool:
+    """Кэшируем только окончательный ответ: 429, 5xx и отказы по ключу уходят в повторы и предохранитель."""
+    return not isinstance(error, aiohttp.ClientResponseError) or error.status in _DEFINITIVE_STATUSES
+
+
+_storages: list[cache.Storage] = []
+
+
+def _restore_storage(ttl: int, name: str) -> cache.Storage:
+    # С воркерами sqlite-файлы хранилищ общие на все процессы, память - только короткий локальный кэш.
+    storage = cache.Storage.restore(ttl, name, config.CACHE_MAX_ENTRIES, config.CACHE_MAX_BYTES,
+                                    config.CACHE_SWEEP_INTERVAL_SECONDS, _NEGATIVE_CACHE_TTLS,
+                                    config.CACHE_NOT_FOUND_TTL_SECONDS,
+                                    config.CORE_WORKERS_LOCAL_CACHE_TTL_SECONDS if config.CORE_WORKERS else 0,
+                                    _is_definitive_failure)
+    _storages.append(storage)
+    return storage
+
+
 youtube_api = youtube.Api(
     config.YOUTUBE_API_KEY,
-    throttling.RateLimiter(config.YOUTUBE_TIMEOUT_SECONDS),
-    cache.Storage.restore(config.YOUTUBE_CACHE_TTL_SECONDS, 'youtube')
+    config.YOUTUBE_API_BASE_URL,
+    throttling.TokenBucket(config.YOUTUBE_RATE_PER_SECOND, config.YOUTUBE_RATE_BURST, 'youtube'),
+    _restore_storage(config.YOUTUBE_CACHE_TTL_SECONDS, 'youtube'),
+    _build_pool(),
+    _build_policy('youtube')
 )
 assistant_api = ai.Assistant(
     config.AI_SYSTEM_PROMPT,
-    config.AI_BASE_URL,
+    config.AI_BASE_URLS,
     config.AI_MODEL,
     config.AI_TEMPERATURE,
     config.AI_MAX_TOKENS,
     config.AI_STREAM,
-    cache.Storage.restore(config.AI_CACHE_TTL_SECONDS, 'ai')
+    _restore_storage(config.AI_CACHE_TTL_SECONDS, 'ai'),
+    _build_pool(config.AI_POOL_SIZE, config.AI_READ_TIMEOUT_SECONDS, config.AI_TOTAL_TIMEOUT_SECONDS),
+    _build_policy('ai'),
+    config.AI_BACKEND_CONCURRENCY,
+    config.AI_HEDGE_PERCENTILE
 )
+titles_index = titles.Index.restore()
 kinopoisk_api = kinopoisk.Api(
     config.KINOPOISK_API_KEY,
     config.KINOPOISK_API_BASE_URL,
-    cache.Storage.restore(config.KINOPOISK_CACHE_TTL_SECONDS, 'kinopoisk')
+    _restore_storage(config.KINOPOISK_CACHE_TTL_SECONDS, 'kinopoisk'),
+    _build_pool(),
+    _build_policy('kinopoisk'),
+    titles_index.add
 )
 karelia_pro_api = karelia_pro.Api(
-    cache.Storage.restore(config.KARELIA_PRO_CACHE_TTL_SECONDS, 'karelia_pro'),
-    throttling.RateLimiter(config.KARELIA_PRO_TIMEOUT_SECONDS),
-    config.KARELIA_PRO_BASE_URL
+    _restore_storage(config.KARELIA_PRO_CACHE_TTL_SECONDS, 'karelia_pro'),
+    throttling.TokenBucket(config.KARELIA_PRO_RATE_PER_SECOND, config.KARELIA_PRO_RATE_BURST, 'karelia_pro'),
+    config.KARELIA_PRO_BASE_URL,
+    _build_pool(),
+    _build_policy('karelia_pro')
 )
+answers_storage = _restore_storage(config.ANSWER_CACHE_TTL_SECONDS, 'answers')
+workers_pool: workers.Pool | None = None
+admission_queue = admission.Queue(config.ADMISSION_MAX_CONCURRENCY, config.ADMISSION_MAX_QUEUE,
+                                  config.ADMISSION_USER_IN_FLIGHT, config.ADMISSION_USER_PER_MINUTE)
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 
 
-def prepare_answer(link: str, username: str, _id: str, provider: str = None) -> tuple[str | None, str | None]:
-    if not (video_id := youtube.parse_video_id_by_link(link)):
+async def dispatch_answer(link: str, username: str, _id: str, provider: str = None) -> tuple[str | None, str | None]:
+    if workers_pool is not None:
+        return await workers_pool.prepare_answer(link, username, _id, provider)
+
+    return await prepare_answer(link, username, _id, provider)
+
+
+def admit(tg_id: int):
+    return admission_queue.slot(tg_id)
+
+
+async def prepare_answer(link: str, username: str, _id: str, provider: str = None) -> tuple[str | None, str | None]:
+    with metrics.span('link'):
+        video_id = youtube.parse_video_id_by_link(link)
+    if not video_id:
         log.warning(strings.username_action(username, 'video_id not found'), _id)
         return None, config.TELEGRAM_BOT_ERROR_NOT_FOUND_VIDEO_ID
     log.debug(strings.username_action(username, 'found video id'), _id, video_id)
 
-    if not (summary := youtube_api.get_video_summary_by_id(video_id, config.YOUTUBE_MAX_COMMENTS, _id)):
+    answer_key = answers.build_key(video_id, provider)
+    if answer := await answers_storage.get_async(answer_key):
+        log.debug(strings.username_action(username, 'answer from cache'), _id, video_id)
+        return answer.render()
+
+    if not (summary := await youtube_api.get_video_summary_by_id(video_id, config.YOUTUBE_MAX_COMMENTS, _id)):
         log.warning(strings.username_action(username, 'summary not build'), video_id, _id)
         return None, config.TELEGRAM_BOT_ERROR_NOT_FOUND_VIDEO_ID
     log.debug(strings.username_action(username, 'fetch summary'), _id, summary)
 
-    if not (assistant_movie := assistant_api.find_movie_by_summary(summary.json(), _id)):
-        log.warning(strings.username_action(username, 'assistant not answer'), summary, _id)
-        return None, config.TELEGRAM_BOT_ERROR_MODEL_UNAVAILABLE
-    log.debug(strings.username_action(username, 'assistant answered'), _id, assistant_movie)
+    prompt = summary.json(config.AI_PROMPT_MAX_CHARS)
+    assistant_task = None
+    if config.CORE_SPECULATIVE:
+        assistant_task = asyncio.ensure_future(assistant_api.find_movie_by_summary(prompt, _id))
+    try:
+        heuristic, prefetched = await approve_by_heuristics(summary, _id)
+        if heuristic:
+            assistant_movie, movie, score = heuristic
+            log.debug(strings.username_action(username, 'heuristics answered'), _id, assistant_movie)
+        else:
+            if assistant_task is None:
+                assistant_task = asyncio.ensure_future(assistant_api.find_movie_by_summary(prompt, _id))
+            if not (assistant_movie := await assistant_task):
+                log.warning(strings.username_action(username, 'assistant not answer'), summary, _id)
+                return None, config.TELEGRAM_BOT_ERROR_MODEL_UNAVAILABLE
+            log.debug(strings.username_action(username, 'assistant answered'), _id, assistant_movie)
 
-    movie, score = approve_movie(assistant_movie, config.MOVIE_HALF_APPROVE_THRESHOLD, _id)
+            movie, score = (approve_prefetched_movie(assistant_movie, prefetched) or
+                            await approve_movie(assistant_movie, config.MOVIE_HALF_APPROVE_THRESHOLD, _id))
+    finally:
+        if assistant_task is not None and not assistant_task.done():
+            assistant_task.cancel()
     log.debug(messages.score_log_msg(
         assistant_movie,
         movie.name_with_year() if movie else '',
@@ -64,17 +166,85 @@ def prepare_answer(link: str, username: str, _id: str, provider: str = None) ->
         username
     ), video_id, _id)
 
+    answer = await build_answer(assistant_movie, movie, score, provider)
+    if ttl := answer_cache_ttl(answer, provider):
+        answers_storage.put(answer_key, answer, ttl)
+
+    return answer.render()
+
+
+async def build_answer(assistant_movie: str, movie: kinopoisk.Movie | None, score: int,
+                       provider: str | None) -> answers.Answer:
     if score < config.MOVIE_NOT_APPROVE_THRESHOLD:
-        return None, messages.not_approved_movie_msg(assistant_movie)
+        return answers.Answer(answers.Answer.OUTCOME_NOT_APPROVED, assistant_movie, movie, score)
 
     if score < config.MOVIE_HALF_APPROVE_THRESHOLD:
-        return None, messages.half_approved_movie_msg(assistant_movie, movie.name_with_year())
+        return answers.Answer(answers.Answer.OUTCOME_HALF_APPROVED, assistant_movie, movie, score)
+
+    return answers.Answer(answers.Answer.OUTCOME_APPROVED, assistant_movie, movie, score,
+                          await find_provider_link(provider, movie))
+
+
+def answer_cache_ttl(answer: answers.Answer, provider: str | None) -> int:
+    """0 - ответ не кэшируем: ссылка провайдера не нашлась (возможно, из-за сбоя) или фильм не подтверждён."""
+    if answer.outcome == answers.Answer.OUTCOME_NOT_APPROVED:
+        return config.ANSWER_NOT_APPROVED_CACHE_TTL_SECONDS
+    if answer.outcome == answers.Answer.OUTCOME_APPROVED and provider and not answer.provider_link:
+        return 0
+
+    return config.ANSWER_CACHE_TTL_SECONDS
+
+
+def forget_answer(link: str) -> str:
+    if not (video_id := youtube.parse_video_id_by_link(link)):
+        return config.TELEGRAM_BOT_ERROR_NOT_FOUND_VIDEO_ID
+
+    for provider in [None, karelia_pro.PROVIDER]:
+        answers_storage.delete(answers.build_key(video_id, provider))
+
+    return config.TELEGRAM_BOT_ANSWER_FORGOTTEN
+
+
+async def approve_by_heuristics(summary: youtube.VideoSummary,
+                                _id: str) -> tuple[tuple[str, kinopoisk.Movie, int] | None, list[kinopoisk.Movie]]:
+    if not config.HEURISTICS_ENABLED:
+        return None, []
+
+    candidates = heuristics.extract_candidates(summary, config.HEURISTICS_MAX_CANDIDATES)
+    approved = next(((candidate, *indexed) for candidate in candidates
+                     if (indexed := get_indexed_movie(candidate))), None)
+
+    prefetched = []
+    if not approved and candidates:
+        try:
+            # Эвристика стоит перед LLM - её поиск не должен заметно удлинять ответ.
+            found = await asyncio.wait_for(
+                asyncio.gather(*[kinopoisk_api.movie_search(candidate, _id) for candidate in candidates]),
+                config.HEURISTICS_TIMEOUT_SECONDS or None)
+        except asyncio.TimeoutError:
+            log.debug('heuristics lookup timed out', _id, candidates)
+            found = []
+        for candidate, movies in zip(candidates, found):
+            prefetched += movies
+            if not approved and (movie_with_score := approve_prefetched_movie(candidate, movies)):
+                approved = candidate, *movie_with_score
+
+    heuristics.stats.record(approved is not None)
+    metrics.inc('heuristics_total', result='win' if approved else 'miss')
+    log.debug(f'heuristics fast path wins {heuristics.stats}', _id)
+    return approved, prefetched
+
 
-    return build_with_provider_answer(provider, movie)
+def approve_prefetched_movie(candidate: str, movies: list[kinopoisk.Movie]) -> tuple[kinopoisk.Movie, int] | None:
+    # Документы искались по другому запросу - как и в индексе, одобряем только полное совпадение с годом.
+    return _confident_movie(candidate, list({movie.id: movie for movie in movies}.values()))
 
 
-def approve_movie(candidate: str, fast_approve_threshold: int, _id: str) -> tuple[kinopoisk.Movie | None, int]:
-    movie, score = get_kinopoisk_movie(candidate, _id)
+async def approve_movie(candidate: str, fast_approve_threshold: int, _id: str) -> tuple[kinopoisk.Movie | None, int]:
+    if indexed := get_indexed_movie(candidate):
+        return indexed
+
+    movie, score = await get_kinopoisk_movie(candidate, _id)
     if score > fast_approve_threshold:
         return movie, score
 
@@ -82,7 +252,7 @@ def approve_movie(candidate: str, fast_approve_threshold: int, _id: str) -> tupl
     if candidate_without_year == candidate:
         return movie, score
 
-    movie_by_name, score_by_name = get_kinopoisk_movie(candidate_without_year, _id)
+    movie_by_name, score_by_name = await get_kinopoisk_movie(candidate_without_year, _id)
     if score_by_name > score:
         return movie_by_name, score_by_name
 
@@ -93,15 +263,68 @@ def get_hello_message() -> str:
     return config.TELEGRAM_BOT_START_MESSAGE
 
 
+def get_busy_message() -> str:
+    return config.TELEGRAM_BOT_ERROR_BUSY
+
+
 def get_telegram_bot_token() -> str:
     return config.TELEGRAM_BOT_TOKEN
 
 
+async def start_metrics() -> web.AppRunner | None:
+    if not config.METRICS_PORT:
+        return None
+
+    return await metrics.start_server(config.METRICS_HOST, config.METRICS_PORT)
+
+
+async def start_workers() -> workers.Pool | None:
+    global workers_pool
+    if not config.CORE_WORKERS:
+        return None
+
+    # Перенос старых архивов должен закончиться до того, как воркеры откроют те же хранилища.
+    for storage in _storages:
+        await asyncio.to_thread(storage.wait_restored)
+    workers_pool = workers.Pool(config.CORE_WORKERS, config.METRICS_HOST, config.METRICS_PORT)
+    workers_pool.start()
+    return workers_pool
+
+
+def start_sweeping():
+    for storage in _storages:
+        storage.start_sweeping()
+
+
+async def stop_sweeping():
+    for storage in _storages:
+        await storage.stop_sweeping()
+
+
+def log_timings(username: str, _id: str, timings: str):
+    if config.METRICS_TIMING_LOG and timings:
+        log.info(strings.username_action(username, f'timings {timings}'), _id)
+
+
 def shutdown():
     youtube_api.shutdown()
     assistant_api.shutdown()
     kinopoisk_api.shutdown()
     karelia_pro_api.shutdown()
+    answers_storage.archive()
+
+
+async def drain(timeout: float):
+    """Запросы под single-flight доживают после ответа пользователю - дожидаемся их до закрытия сессий."""
+    if pending := asyncio.all_tasks() - {asyncio.current_task()}:
+        await asyncio.wait(pending, timeout=timeout)
+
+
+async def close():
+    await youtube_api.close()
+    await assistant_api.close()
+    await kinopoisk_api.close()
+    await karelia_pro_api.close()
 
 
 def map_kinopoisk_to_karelia_pro(kinopoisk_type: str) -> str:
@@ -115,12 +338,20 @@ def map_kinopoisk_to_karelia_pro(kinopoisk_type: str) -> str:
         return karelia_pro.Content.TYPE_VIDEO
 
 
-def build_with_provider_answer(provider: str | None, movie: kinopoisk.Movie) -> tuple[str | None, str | None]:
+async def build_with_provider_answer(provider: str | None, movie: kinopoisk.Movie) -> tuple[str | None, str | None]:
+    return messages.approved_movie(movie.name_with_year(), movie.link(), await find_provider_link(provider, movie)), None
+
+
+async def find_provider_link(provider: str | None, movie: kinopoisk.Movie) -> str | None:
     if provider == karelia_pro.PROVIDER:
-        content = karelia_pro_api.movie_search(movie.name(), map_kinopoisk_to_karelia_pro(movie.type), movie.id)
+        content = await karelia_pro_api.movie_search(movie.name(), map_kinopoisk_to_karelia_pro(movie.type), movie.id)
         if content:
-            return messages.approved_movie(movie.name_with_year(), movie.link(), content.link()), None
-    return messages.approved_movie(movie.name_with_year(), movie.link()), None
+            return content.link()
+    return None
+
+
+def is_admin(tg_id) -> bool:
+    return str(tg_id) in config.TELEGRAM_BOT_ADMINS
 
 
 def get_provider(tg_id) -> str | None:
@@ -129,13 +360,66 @@ def get_provider(tg_id) -> str | None:
     return None
 
 
-def get_kinopoisk_movie(candidate: str, _id: str) -> tuple[kinopoisk.Movie | None, int]:
-    movies = kinopoisk_api.movie_search(candidate, _id)
-    if movie := movies[0] if len(movies) > 0 else None:
-        score = 0
-        for name in movie.names_with_year():
-            score = max(matcher.calculate_match_score(candidate, name), score)
-
-        return movie, score
+async def get_kinopoisk_movie(candidate: str, _id: str) -> tuple[kinopoisk.Movie | None, int]:
+    movies = await kinopoisk_api.movie_search(candidate, _id)
+    if ranked := rank_kinopoisk_movies(candidate, movies):
+        return ranked[0]
 
     return None, 0
+
+
+def get_indexed_movie(candidate: str) -> tuple[kinopoisk.Movie, int] | None:
+    return _confident_movie(candidate, titles_index.search(candidate))
+
+
+def _confident_movie(candidate: str, movies: list[kinopoisk.Movie]) -> tuple[kinopoisk.Movie, int] | None:
+    # Без поиска по самому кандидату одобряем только полное совпадение названия и года: частичное совпадение
+    # ("Игра" в "Кальмар: Игра") уверенно выбрало бы не тот фильм.
+    if not (year := strings.extract_year(candidate)):
+        return None
+
+    movies = [movie for movie in movies if movie.year == year and movie.names]
+    scores = matcher.calculate_similarities(strings.clean_year(candidate),
+                                            [name for movie in movies for name in movie.names],
+                                            config.TITLES_INDEX_APPROVE_THRESHOLD)
+    confident = []
+    offset = 0
+    for movie in movies:
+        if score := max(scores[offset:offset + len(movie.names)]):
+            confident.append((movie, score))
+        offset += len(movie.names)
+    if len(confident) == 1:
+        return confident[0]
+
+    return None
+
+
+_YEAR_MATCH_BONUS = 5
+_YEAR_MISMATCH_PENALTY = 10
+_TYPE_BONUS = {
+    kinopoisk.Movie.TYPE_MOVIE: 2,
+    kinopoisk.Movie.TYPE_TV_SERIES: 2,
+    kinopoisk.Movie.TYPE_CARTOON: 1,
+    kinopoisk.Movie.TYPE_ANIMATED_SERIES: 1,
+    kinopoisk.Movie.TYPE_ANIME: 1,
+}
+
+
+def rank_kinopoisk_movies(candidate: str, movies: list[kinopoisk.Movie]) -> list[tuple[kinopoisk.Movie, int]]:
+    movies = [movie for movie in movies if movie.names]
+    names = [name for movie in movies for name in movie.names_with_year()]
+    scores = matcher.calculate_match_scores(candidate, names)
+    year = strings.extract_year(candidate)
+
+    ranked = []
+    offset = 0
+    for movie in movies:
+        score = max(scores[offset:offset + len(movie.names)])
+        offset += len(movie.names)
+        rank = score + _TYPE_BONUS.get(movie.type, 0)
+        if year and movie.year:
+            rank += _YEAR_MATCH_BONUS if year == movie.year else -_YEAR_MISMATCH_PENALTY
+        ranked.append((rank, movie, score))
+
+    ranked.sort(key=lambda item: item[0], reverse=True)
+    return [(movie, score) for _, movie, score in ranked]
@@ -1,6 +1,10 @@
 import os
 
-_STORAGE_PATH = '/app/storage'
+import config
+
+_STORAGE_PATH = config.STORAGE_PATH
+EXTENSION_CACHE = 'cache'
+EXTENSION_SQLITE = 'sqlite'
 
 
 def save_file(filename, data: bytes):
@@ -15,5 +19,19 @@ def read_file(filename) -> bytes | None:
         return f.read()
 
 
-def build_storage_path(name: str) -> str:
-    return f'{_STORAGE_PATH}/{name}.cache'
+def exists(filename) -> bool:
+    return os.path.exists(filename)
+
+
+def move_file(filename, destination):
+    if os.path.exists(filename):
+        os.replace(filename, destination)
+
+
+def remove_file(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def build_storage_path(name: str, extension: str = EXTENSION_CACHE) -> str:
+    return f'{_STORAGE_PATH}/{name}.{extension}'
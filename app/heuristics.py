@@ -0,0 +1,58 @@
+import re
+
+import youtube
+
+# Только единственное число: "Фильмы - это жизнь" или "топ сериалов" - не название конкретного фильма.
+_KEYWORDS = (r'\b(?:(?:мульт)?фильм(?:а|е|у|ом)?|(?:мульт)?сериал(?:а|е|у|ом)?|аниме|'
+             r'название(?: фильма| сериала)?|film|movie|series)\b')
+_YEAR = r'(?:19|20)\d{2}'
+_QUOTED = re.compile(rf'{_KEYWORDS}\s*[:\-–—]?\s*[«"“]([^»"”\n]{{2,100}})[»"”]\s*(?:\(?({_YEAR})\)?)?',
+                     re.IGNORECASE)
+_QUOTED_WITH_YEAR = re.compile(rf'[«"“]([^»"”\n]{{2,100}})[»"”]\s*\(({_YEAR})\)')
+_UNQUOTED = rf'{_KEYWORDS}\s*[:\-–—]\s*([^\n(\[|#«»"“”]{{2,80}}?)\s*'
+_UNQUOTED_WITH_YEAR = re.compile(rf'{_UNQUOTED}\(({_YEAR})\)', re.IGNORECASE)
+_UNQUOTED_IN_TITLE = re.compile(rf'{_UNQUOTED}(?:\(({_YEAR})\)|(?=[\n.|#,]|$))', re.IGNORECASE)
+# «Название (год)» без ключевого слова - только в заголовке: в описании так выглядит любая строка с датой.
+_BARE_TITLE = re.compile(rf'^([^\n()|#«»"“”]{{2,80}}?)\s*\(({_YEAR})\)')
+# Вне заголовка название принимаем только в кавычках или с годом.
+_PATTERNS = [_QUOTED, _UNQUOTED_WITH_YEAR, _QUOTED_WITH_YEAR]
+_TITLE_PATTERNS = [_QUOTED, _UNQUOTED_IN_TITLE, _QUOTED_WITH_YEAR, _BARE_TITLE]
+_PREFIX = re.compile(rf'^{_KEYWORDS}\s*[:\-–—]\s*', re.IGNORECASE)
+
+
+def _clean(name: str) -> str:
+    return _PREFIX.sub('', name.strip(' .,:;-–—«»"“”')).strip(' «»"“”')
+
+
+class Stats:
+    attempts: int = 0
+    wins: int = 0
+
+    def record(self, won: bool):
+        self.attempts += 1
+        if won:
+            self.wins += 1
+
+    def win_rate(self) -> float:
+        return self.wins / self.attempts if self.attempts else 0
+
+    def __str__(self):
+        return f'{self.wins}/{self.attempts} ({self.win_rate():.0%})'
+
+
+stats = Stats()
+
+
+def extract_candidates(summary: youtube.VideoSummary, limit: int = 3) -> list[str]:
+    candidates = []
+    texts = [(summary.title, _TITLE_PATTERNS)]
+    texts += [(text, _PATTERNS) for text in [summary.description or ''] + summary.owner_comments]
+    for text, patterns in texts:
+        for pattern in patterns:
+            for match in pattern.finditer(text):
+                name = _clean(match.group(1))
+                candidate = f'{name} ({match.group(2)})' if match.group(2) else name
+                if name and candidate not in candidates:
+                    candidates.append(candidate)
+
+    return candidates[:limit]
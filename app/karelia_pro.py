@@ -1,9 +1,13 @@
+import asyncio
 from dataclasses import dataclass
 
-import requests
+import aiohttp
 
 import cache
 import log
+import metrics
+import resilience
+import sessions
 import throttling
 
 _USER_AGENT = ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) "
@@ -37,19 +41,19 @@ class Api:
         Content.TYPE_MULT: 5,
     }
 
-    def __init__(self, storage: cache.Storage, limiter: throttling.RateLimiter, base_url: str):
+    def __init__(self, storage: cache.Storage, limiter: throttling.TokenBucket, base_url: str, pool: sessions.Pool,
+                 policy: resilience.Policy):
         self._storage = storage
         self._limiter = limiter
         self._base_url = base_url
+        self._pool = pool
+        self._policy = policy
 
-    def movie_search(self, query: str, _type: str, kp_id=None) -> Content | None:
-        @throttling.with_limiter(self._limiter)
-        def _search(q, t, kp):
-            return self.perform_query(q, t, kp)
+    @metrics.timed('karelia_pro')
+    async def movie_search(self, query: str, _type: str, kp_id=None) -> Content | None:
+        return await self.perform_query(query, _type, kp_id)
 
-        return _search(query, _type, kp_id)
-
-    def perform_query(self, query: str, _type: str, kp_id) -> Content | None:
+    async def perform_query(self, query: str, _type: str, kp_id) -> Content | None:
         url = f"http://{self._base_url}/ajax/search/1"
         params = {
             "query": query,
@@ -66,13 +70,14 @@ class Api:
         }
 
         @cache.with_cache(self._storage)
-        def execute(_params):
-            resp = requests.get(url, params=_params, headers=headers, verify=False)
-            resp.raise_for_status()
-            return resp.json()
+        @resilience.with_policy(policy=self._policy, limiter=self._limiter)
+        async def execute(_params):
+            async with self._pool.session().get(url, params=_params, headers=headers, ssl=False) as resp:
+                resp.raise_for_status()
+                return await resp.json(content_type=None)
 
         try:
-            response = execute(params)
+            response = await execute(params)
             for content_data in response.get("videos", []):
                 if str(content_data.get('kinopoiskId', '')) == str(kp_id):
                     return Content(
@@ -80,10 +85,15 @@ class Api:
                         _type,
                         content_data.get('title'),
                     )
-        except requests.exceptions.HTTPError as e:
+        except resilience.CircuitOpenException as e:
+            log.warning(str(e), query)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             log.exception(e, query)
 
         return None
 
     def shutdown(self):
         self._storage.archive()
+
+    async def close(self):
+        await self._pool.close()
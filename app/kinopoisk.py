@@ -1,10 +1,15 @@
+import asyncio
 from dataclasses import dataclass
+from typing import Callable
 
-import log
+import aiohttp
 
-import requests
+import log
 
 import cache
+import metrics
+import resilience
+import sessions
 
 
 @dataclass
@@ -44,56 +49,77 @@ class Movie:
 class Api:
     _api_key: str
     _base_url: str
+    _policy: resilience.Policy
+    _on_movies: Callable[[list[Movie]], None] | None
 
-    def __init__(self, api_key: str, base_url: str, storage: cache.Storage):
+    def __init__(self, api_key: str, base_url: str, storage: cache.Storage, pool: sessions.Pool,
+                 policy: resilience.Policy, on_movies: Callable[[list[Movie]], None] = None):
         self._api_key = api_key
         self._base_url = base_url
         self._storage = storage
+        self._pool = pool
+        self._policy = policy
+        self._on_movies = on_movies
 
-    def movie_search(self, query: str, _id: str, page: int = 1, limit: int = 10) -> list[Movie]:
+    @metrics.timed('kinopoisk')
+    async def movie_search(self, query: str, _id: str, page: int = 1, limit: int = 10) -> list[Movie]:
         @cache.with_cache(self._storage)
-        def execute(_query) -> list[dict]:
-            data = self._execute_request(_query, page, limit)
+        async def execute(_query) -> list[dict]:
+            data = await self._execute_request(_query, page, limit)
             if 'docs' not in data:
-                raise Exception('not found movie data', data)
+                raise MovieDataNotFoundException('not found movie data', data)
+
+            docs = data.get("docs", [])
+            if self._on_movies:
+                self._on_movies([parse_movie_data(movie_data) for movie_data in docs])
 
-            return data.get("docs", [])
+            return docs
 
         try:
             movies = []
-            for movie_data in execute(query):
-                movie = _parse_movie_data(movie_data)
+            for movie_data in await execute(query):
+                movie = parse_movie_data(movie_data)
                 movies.append(movie)
 
             return movies
-        except Exception as e:
+        except resilience.CircuitOpenException as e:
+            log.warning(str(e), _id)
+            return []
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, MovieDataNotFoundException) as e:
             log.exception(e, _id)
             return []
 
     def shutdown(self):
         self._storage.archive()
 
-    def _execute_request(self, query: str, page: int = 1, limit: int = 10) -> dict:
-        return ((requests.get(f"{self._base_url}/v1.4/movie/search",
-                              headers={
-                                  "accept": "application/json",
-                                  "X-API-KEY": self._api_key
-                              },
-                              params={
-                                  "page": page,
-                                  "limit": limit,
-                                  "query": query
-                              }))
-                .json())
-
-
-def _parse_movie_data(movie_data: dict) -> Movie:
+    async def close(self):
+        await self._pool.close()
+
+    async def _execute_request(self, query: str, page: int = 1, limit: int = 10) -> dict:
+        return await self._policy.call(self._fetch, query, page, limit)
+
+    async def _fetch(self, query: str, page: int, limit: int) -> dict:
+        async with self._pool.session().get(f"{self._base_url}/v1.4/movie/search",
+                                            headers={
+                                                "accept": "application/json",
+                                                "X-API-KEY": self._api_key
+                                            },
+                                            params={
+                                                "page": page,
+                                                "limit": limit,
+                                                "query": query
+                                            }) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+
+def parse_movie_data(movie_data: dict) -> Movie:
     alternative_names = [
                             movie_data.get("name", ''),
                             movie_data.get("alternativeName", ''),
                             movie_data.get("enName", '')
                         ] + [
-                            item.get("name", '') for item in movie_data['names']
+                            item.get("name", '') for item in movie_data.get('names') or []
                         ]
     return Movie(
         movie_data.get("id", -1),
@@ -101,3 +127,7 @@ def _parse_movie_data(movie_data: dict) -> Movie:
         movie_data.get("year"),
         movie_data.get("type"),
     )
+
+
+class MovieDataNotFoundException(Exception):
+    pass
@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import gc
+import itertools
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import AsyncGenerator, Callable
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendMessage, TelegramMethod
+from aiogram.types import Chat, Message, MessageEntity, Update, User
+
+import benchmark
+import standins
+
+_BOT_TOKEN = '42:LOADTEST'
+
+
+class FakeSession(BaseSession):
+    """Сессия Bot API без сети: запоминает время каждого ответа в чат."""
+    replies: dict[int, tuple[float, str]]
+    _latency: float
+    _message_ids: itertools.count
+
+    def __init__(self, latency: float = 0):
+        super().__init__()
+        self.replies = {}
+        self._latency = latency
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int = None):
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        if not isinstance(method, SendMessage):
+            return True
+
+        self.replies[method.chat_id] = time.perf_counter(), method.text
+        return Message(message_id=next(self._message_ids), date=datetime.now(),
+                       chat=Chat(id=method.chat_id, type='private'), text=method.text)
+
+    async def stream_content(self, url: str, headers: dict = None, timeout: int = 30, chunk_size: int = 65536,
+                             raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        # Бот под нагрузкой только отвечает текстом и файлов не скачивает - отдавать нечего.
+        return
+        yield
+
+    async def close(self):
+        pass
+
+
+class LoopLagMonitor:
+    """Раз в interval просыпается и меряет, насколько позже срока это удалось."""
+    samples: list[float]
+    concurrency: list[int]
+    _interval: float
+    _in_flight: Callable[[], int]
+
+    def __init__(self, interval: float, in_flight: Callable[[], int]):
+        self.samples = []
+        self.concurrency = []
+        self._interval = interval
+        self._in_flight = in_flight
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected_at = loop.time() + self._interval
+            await asyncio.sleep(self._interval)
+            self.samples.append(max(0.0, loop.time() - expected_at))
+            self.concurrency.append(self._in_flight())
+
+
+def build_update(update_id: int, chat_id: int, link: str) -> Update:
+    text = f'Что за фильм? {link}'
+    user = User(id=chat_id, is_bot=False, first_name='Load', username=f'load{chat_id}')
+    return Update(update_id=update_id, message=Message(
+        message_id=update_id,
+        date=datetime.now(),
+        chat=Chat(id=chat_id, type='private'),
+        from_user=user,
+        text=text,
+        entities=[MessageEntity(type='url', offset=text.index(link), length=len(link))],
+    ))
+
+
+def rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Нет /proc (macOS): доступен только пиковый RSS.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+async def _run_round(dp, bot: Bot, session: FakeSession, links: list[str], chats: int, first_update_id: int,
+                     error_texts: set[str], lag_interval: float) -> dict:
+    in_flight = 0
+    peak = 0
+    started = {}
+
+    async def feed(update_id: int, chat_id: int, link: str):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        started[chat_id] = time.perf_counter()
+        try:
+            await dp.feed_update(bot, build_update(update_id, chat_id, link))
+        finally:
+            in_flight -= 1
+
+    session.replies.clear()
+    monitor = LoopLagMonitor(lag_interval, lambda: in_flight)
+    monitor_task = asyncio.ensure_future(monitor.run())
+    round_started_at = time.perf_counter()
+    try:
+        await asyncio.gather(*[feed(first_update_id + i, 1000 + i, links[i % len(links)]) for i in range(chats)])
+    finally:
+        monitor_task.cancel()
+    duration = time.perf_counter() - round_started_at
+
+    latencies = [replied_at - started[chat_id] for chat_id, (replied_at, _) in session.replies.items()]
+    return {
+        'chats': chats,
+        'replies': len(session.replies),
+        'errors': sum(text in error_texts for _, text in session.replies.values()),
+        'duration': duration,
+        'peak_concurrency': peak,
+        'mean_concurrency': sum(monitor.concurrency) / len(monitor.concurrency) if monitor.concurrency else peak,
+        'reply_p50': benchmark.percentile(latencies, 50),
+        'reply_p95': benchmark.percentile(latencies, 95),
+        'reply_p99': benchmark.percentile(latencies, 99),
+        'lag_p99': benchmark.percentile(monitor.samples, 99),
+        'lag_max': max(monitor.samples, default=0),
+    }
+
+
+def _format_round(number: int, stats: dict, rss_growth: int) -> str:
+    return (f'round {number}: chats={stats["chats"]} replies={stats["replies"]} errors={stats["errors"]} '
+            f'duration={stats["duration"]:.2f}s concurrency peak={stats["peak_concurrency"]} '
+            f'mean={stats["mean_concurrency"]:.1f} reply p50={stats["reply_p50"]:.3f}s '
+            f'p95={stats["reply_p95"]:.3f}s p99={stats["reply_p99"]:.3f}s loop lag p99={stats["lag_p99"] * 1000:.1f}ms '
+            f'max={stats["lag_max"] * 1000:.1f}ms rss {rss_growth / 2 ** 20:+.1f}MB')
+
+
+def check_gates(args: argparse.Namespace, rounds: list[dict], steady_growth: int) -> list[str]:
+    """Нарушенные пороги; пустой список - прогон годен как регрессионный гейт."""
+    failures = []
+    for number, stats in enumerate(rounds, 1):
+        if stats['replies'] < stats['chats']:
+            failures.append(f'round {number}: {stats["chats"] - stats["replies"]} chats got no reply')
+        if stats['errors'] > args.max_errors:
+            failures.append(f'round {number}: {stats["errors"]} error replies > {args.max_errors}')
+        if args.max_reply_p95 and stats['reply_p95'] > args.max_reply_p95:
+            failures.append(f'round {number}: reply p95 {stats["reply_p95"]:.3f}s > {args.max_reply_p95}s')
+        if args.max_loop_lag and stats['lag_max'] > args.max_loop_lag:
+            failures.append(f'round {number}: loop lag {stats["lag_max"]:.3f}s > {args.max_loop_lag}s')
+    if args.max_rss_growth_mb and steady_growth > args.max_rss_growth_mb * 2 ** 20:
+        failures.append(f'rss grew {steady_growth / 2 ** 20:.1f}MB after the first round > {args.max_rss_growth_mb}MB')
+
+    return failures
+
+
+async def _run(args: argparse.Namespace) -> int:
+    stand_ins = standins.StandIns(args.fixtures, standins.parse_upstream_values(args.latency), args.jitter)
+    runner, base_url = await stand_ins.start()
+    with tempfile.TemporaryDirectory(prefix='loadtest-storage-') as storage_path:
+        benchmark.configure(base_url, args.storage or storage_path, args.unlimited)
+        # Как и в benchmark: config читается при импорте.
+        import config
+        import core
+        import telegram
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+
+        session = FakeSession(args.telegram_latency)
+        bot = Bot(token=_BOT_TOKEN, session=session)
+        links = [f'https://youtu.be/load{i}' for i in range(args.videos)]
+        error_texts = {config.TELEGRAM_BOT_ERROR_NOT_FOUND_VIDEO_ID, config.TELEGRAM_BOT_ERROR_MODEL_UNAVAILABLE,
+                       config.TELEGRAM_BOT_ERROR_BUSY}
+
+        rounds = []
+        gc.collect()
+        baseline = previous = rss_bytes()
+        try:
+            for number in range(1, args.rounds + 1):
+                stats = await _run_round(telegram.dp, bot, session, links, args.chats, number * args.chats,
+                                         error_texts, args.lag_interval)
+                gc.collect()
+                current = rss_bytes()
+                print(_format_round(number, stats, current - previous))
+                rounds.append(stats)
+                if number == 1:
+                    baseline = current
+                previous = current
+        finally:
+            await core.drain(args.drain_timeout)
+            await core.close()
+            core.shutdown()
+            await runner.cleanup()
+
+    print(f'upstream calls: {dict(stand_ins.calls)}')
+    if failures := check_gates(args, rounds, previous - baseline):
+        print('FAILED\n' + '\n'.join(failures))
+        return 1
+
+    print('OK')
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Нагрузка на telegram.dp синтетическими сообщениями со ссылками.')
+    parser.add_argument('--chats', type=int, default=100, help='одновременных чатов в раунде')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--videos', type=int, default=50, help='разных ссылок')
+    parser.add_argument('--fixtures', help='каталог фикстур для воспроизведения')
+    parser.add_argument('--latency', default='youtube=0.05,ai=0.5,kinopoisk=0.1,karelia_pro=0.1')
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='задержка фейкового Bot API, секунд')
+    parser.add_argument('--lag-interval', type=float, default=0.01, help='период замера лага event loop, секунд')
+    parser.add_argument('--storage', help='каталог хранилища вместо временного')
+    parser.add_argument('--drain-timeout', type=float, default=10, help='ожидание фоновых запросов в конце, секунд')
+    parser.add_argument('--unlimited', action='store_true', help='снять лимиты частоты YouTube и Karelia Pro')
+    parser.add_argument('--max-errors', type=int, default=0)
+    parser.add_argument('--max-reply-p95', type=float, default=0, help='порог p95 ответа, секунд (0 - не проверять)')
+    parser.add_argument('--max-loop-lag', type=float, default=0, help='порог лага event loop, секунд')
+    parser.add_argument('--max-rss-growth-mb', type=float, default=0, help='порог роста RSS после первого раунда')
+    parser.add_argument('--verbose', action='store_true')
+    sys.exit(asyncio.run(_run(parser.parse_args())))
@@ -9,7 +9,13 @@ def exception(e: Exception, *args):
         for arg in args:
             msg = f'{msg} {strings.json(arg)}'
     _args = e.args[1:] if len(e.args) > 1 else []
-    logging.exception(e.__class__(msg, *_args))
+    try:
+        error = e.__class__(msg, *_args)
+        str(error)
+    except Exception:
+        # Не все исключения можно пересоздать по аргументам (например, ошибки соединения aiohttp).
+        error = f'{e.__class__.__name__}: {msg}'
+    logging.exception(error)
 
 
 def error(msg: str, *args):
@@ -1,6 +1,11 @@
 import asyncio
 
+import config
 import telegram
+import webhook
 
 if __name__ == "__main__":
-    asyncio.run(telegram.start_polling())
+    if config.TELEGRAM_BOT_MODE == webhook.MODE:
+        asyncio.run(webhook.start())
+    else:
+        asyncio.run(telegram.start_polling())
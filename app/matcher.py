@@ -1,5 +1,71 @@
+from rapidfuzz import fuzz as rapid_fuzz, process
 from thefuzz import fuzz
 
 
+def normalize(value: str) -> str:
+    return value.lower().replace('ё', 'е')
+
+
+class Choices:
+    values: list[str]
+    normalized: list[str]
+
+    def __init__(self, values: list[str]):
+        self.values = values
+        self.normalized = [normalize(value) for value in values]
+
+    def __len__(self):
+        return len(self.values)
+
+
+def _as_choices(vacations: list[str] | Choices) -> Choices:
+    return vacations if isinstance(vacations, Choices) else Choices(vacations)
+
+
 def calculate_match_score(candidate: str, vacation: str) -> int:
-    return fuzz.partial_ratio(candidate.lower(), vacation.lower())
+    return fuzz.partial_ratio(normalize(candidate), normalize(vacation))
+
+
+def calculate_similarity(first: str, second: str) -> int:
+    return int(round(rapid_fuzz.ratio(normalize(first), normalize(second))))
+
+
+def calculate_similarities(candidate: str, vacations: list[str] | Choices, score_cutoff: int = 0) -> list[int]:
+    """calculate_similarity для всех вариантов одним вызовом rapidfuzz."""
+    choices = _as_choices(vacations)
+    scores = [0] * len(choices)
+    for _, score, index in _extract(normalize(candidate), choices, None, score_cutoff, rapid_fuzz.ratio):
+        scores[index] = int(round(score))
+
+    return scores
+
+
+def calculate_match_scores(candidate: str, vacations: list[str] | Choices, score_cutoff: int = 0) -> list[int]:
+    choices = _as_choices(vacations)
+    scores = [0] * len(choices)
+    for _, score, index in _extract(normalize(candidate), choices, None, score_cutoff):
+        scores[index] = int(round(score))
+
+    return scores
+
+
+def calculate_match_matrix(candidates: list[str], vacations: list[str] | Choices,
+                           score_cutoff: int = 0) -> list[list[int]]:
+    choices = _as_choices(vacations)
+    return [calculate_match_scores(candidate, choices, score_cutoff) for candidate in candidates]
+
+
+def top_matches(candidate: str, vacations: list[str] | Choices, limit: int = 5,
+                score_cutoff: int = 0) -> list[tuple[str, int, int]]:
+    choices = _as_choices(vacations)
+    return [(choices.values[index], int(round(score)), index)
+            for _, score, index in _extract(normalize(candidate), choices, limit, score_cutoff)]
+
+
+def _extract(query: str, choices: Choices, limit: int | None, score_cutoff: int,
+             scorer=rapid_fuzz.partial_ratio) -> list[tuple[str, float, int]]:
+    if not choices.normalized:
+        return []
+
+    # rapidfuzz 3.x: limit=None - все варианты, для списка результат (значение, оценка, индекс).
+    return process.extract(query, choices.normalized, scorer=scorer, limit=limit, score_cutoff=score_cutoff or None)
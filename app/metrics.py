@@ -0,0 +1,146 @@
+import bisect
+import contextlib
+import contextvars
+import inspect
+import threading
+import time
+
+from aiohttp import web
+
+import log
+
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_lock = threading.Lock()
+_counters: dict[tuple[str, tuple], float] = {}
+_histograms: dict[tuple[str, tuple], '_Histogram'] = {}
+_request_timings: contextvars.ContextVar[dict | None] = contextvars.ContextVar('request_timings', default=None)
+
+
+class _Histogram:
+    counts: list[int]
+    total = 0.0
+    count = 0
+
+    def __init__(self):
+        self.counts = [0] * len(_BUCKETS)
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(_BUCKETS, value)
+        if index < len(_BUCKETS):
+            self.counts[index] += 1
+        self.total += value
+        self.count += 1
+
+
+def inc(name: str, amount: float = 1, **labels):
+    key = name, tuple(sorted(labels.items()))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name: str, value: float, **labels):
+    key = name, tuple(sorted(labels.items()))
+    with _lock:
+        if (histogram := _histograms.get(key)) is None:
+            histogram = _histograms[key] = _Histogram()
+        histogram.observe(value)
+
+
+@contextlib.contextmanager
+def span(stage: str):
+    """Замеряет этап: гистограмма stage_duration_seconds и строка таймингов текущего запроса."""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started_at
+        observe('stage_duration_seconds', elapsed, stage=stage)
+        if (timings := _request_timings.get()) is not None:
+            timings.setdefault(stage, []).append(elapsed)
+
+
+def timed(stage: str):
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def start_request() -> contextvars.Token:
+    return _request_timings.set({})
+
+
+def finish_request(token: contextvars.Token) -> str:
+    """Сбрасывает контекст запроса и возвращает строку вида "youtube=0.412 kinopoisk=0.120x2"."""
+    timings = _request_timings.get() or {}
+    _request_timings.reset(token)
+    return ' '.join(f'{stage}={sum(values):.3f}' + (f'x{len(values)}' if len(values) > 1 else '')
+                    for stage, values in timings.items())
+
+
+def render() -> str:
+    lines = []
+    with _lock:
+        for name in sorted({name for name, _ in _counters}):
+            lines.append(f'# TYPE {name} counter')
+            lines += [f'{name}{_format_labels(labels)} {value:g}'
+                      for (_name, labels), value in sorted(_counters.items()) if _name == name]
+
+        for name in sorted({name for name, _ in _histograms}):
+            lines.append(f'# TYPE {name} histogram')
+            for (_name, labels), histogram in sorted(_histograms.items(), key=lambda item: item[0]):
+                if _name != name:
+                    continue
+                cumulative = 0
+                for bucket, count in zip(_BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", f"{bucket:g}"),))} {cumulative}')
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {histogram.count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {histogram.total:.6f}')
+                lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get('/metrics', _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info(f'metrics listening on http://{host}:{port}/metrics')
+    return runner
+
+
+async def _handle_metrics(_request: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={'Content-Type': _CONTENT_TYPE})
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
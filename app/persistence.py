@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import threading
+import time
+
+import log
+
+_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS entries (
+        key TEXT PRIMARY KEY,
+        payload BLOB NOT NULL,
+        expired_at REAL
+    )
+'''
+
+
+_DELETED = None
+_MISSING = object()
+_WRITER_IDLE_SECONDS = 5
+
+
+class SqliteBackend:
+    """Записи пишутся пачками в отдельном потоке: commit в WAL не задерживает event loop."""
+    _path: str
+    _connection: sqlite3.Connection | None = None
+    _lock: threading.Lock
+    _compaction: threading.Thread | None = None
+    _pending: dict[str, tuple[bytes, float | None] | None]
+    _writing: dict[str, tuple[bytes, float | None] | None]
+    _pending_lock: threading.Lock
+    _flush_lock: threading.Lock
+    _wake: threading.Event
+    _writer: threading.Thread | None = None
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._writing = {}
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def write(self, key: str, payload: bytes, expired_at: float | None):
+        self._enqueue({key: (payload, expired_at)})
+
+    def write_many(self, rows: list[tuple[str, bytes, float | None]], replace: bool = True):
+        """replace=False не трогает уже записанные ключи - для переноса старых данных под свежими."""
+        if replace:
+            self._enqueue({key: (payload, expired_at) for key, payload, expired_at in rows})
+            return
+
+        with self._lock:
+            connection = self._connect()
+            connection.executemany('INSERT OR IGNORE INTO entries (key, payload, expired_at) VALUES (?, ?, ?)', rows)
+            connection.commit()
+
+    def items(self) -> list[tuple[str, bytes]]:
+        self.flush()
+        with self._lock:
+            return self._connect().execute('SELECT key, payload FROM entries').fetchall()
+
+    def delete(self, key: str):
+        self._enqueue({key: _DELETED})
+
+    def read(self, key: str) -> tuple[bytes, float | None] | None:
+        with self._pending_lock:
+            row = self._pending.get(key, self._writing.get(key, _MISSING))
+        if row is _MISSING:
+            with self._lock:
+                row = self._connect().execute('SELECT payload, expired_at FROM entries WHERE key = ?',
+                                              (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+
+        return row[0], row[1]
+
+    def flush(self):
+        """Синхронно дописывает накопленные записи."""
+        with self._flush_lock:
+            with self._pending_lock:
+                batch, self._pending = self._pending, {}
+                self._writing = batch
+            if not batch:
+                return
+
+            try:
+                with self._lock:
+                    connection = self._connect()
+                    connection.executemany('INSERT OR REPLACE INTO entries (key, payload, expired_at) VALUES (?, ?, ?)',
+                                           [(key, *row) for key, row in batch.items() if row is not _DELETED])
+                    connection.executemany('DELETE FROM entries WHERE key = ?',
+                                           [(key,) for key, row in batch.items() if row is _DELETED])
+                    connection.commit()
+            finally:
+                with self._pending_lock:
+                    self._writing = {}
+
+    def compact_in_background(self):
+        if self._compaction is not None and self._compaction.is_alive():
+            return
+
+        self._compaction = threading.Thread(target=self.compact, name=f'compact:{self._path}', daemon=True)
+        self._compaction.start()
+
+    def compact(self):
+        self.flush()
+        connection = _open(self._path)
+        try:
+            connection.execute('DELETE FROM entries WHERE expired_at IS NOT NULL AND expired_at < ?', (time.time(),))
+            connection.commit()
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        finally:
+            connection.close()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _enqueue(self, rows: dict[str, tuple[bytes, float | None] | None]):
+        with self._pending_lock:
+            self._pending.update(rows)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_pending, name=f'write:{self._path}', daemon=True)
+                self._writer.start()
+        self._wake.set()
+
+    def _write_pending(self):
+        while True:
+            woken = self._wake.wait(_WRITER_IDLE_SECONDS)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.exception(e, self._path)
+            if not woken:
+                with self._pending_lock:
+                    if not self._pending:
+                        self._writer = None
+                        return
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = _open(self._path)
+
+        return self._connection
+
+
+def _open(path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute(_SCHEMA)
+
+    return connection
@@ -0,0 +1,95 @@
+import json
+import math
+import re
+
+import matcher
+
+_COMMENT_MAX_CHARS = 300
+# Доля бюджета, которую комментарии не могут отнять у описания; их остаток описание забирает себе.
+_DESCRIPTION_SHARE = 0.4
+_DUPLICATE_SIMILARITY = 90
+
+_URL = re.compile(r'https?://\S+|www\.\S+')
+_TIMESTAMP_LINE = re.compile(r'^\s*(?:\d{1,2}:)?\d{1,2}:\d{2}\b.*$', re.MULTILINE)
+_YEAR = re.compile(r'\b(?:19|20)\d{2}\b')
+_QUOTES = re.compile(r'[«"“][^»"”]{2,}[»"”]')
+_KEYWORDS = re.compile(r'фильм|сериал|мульт|аниме|название|кинопоиск|imdb|movie|film|series', re.IGNORECASE)
+
+
+def clean_text(text: str | None) -> str:
+    text = _TIMESTAMP_LINE.sub('', _URL.sub('', text or ''))
+    lines = (re.sub(r'[ \t]+', ' ', line).strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def signal_score(comment: str, likes: int = 0) -> float:
+    score = 0
+    if _YEAR.search(comment):
+        score += 3
+    if _QUOTES.search(comment):
+        score += 3
+    if _KEYWORDS.search(comment):
+        score += 2
+
+    return score + math.log1p(likes)
+
+
+def dedupe(comments: list[str]) -> list[str]:
+    unique = []
+    for comment in comments:
+        if not any(matcher.calculate_similarity(comment, kept) >= _DUPLICATE_SIMILARITY for kept in unique):
+            unique.append(comment)
+
+    return unique
+
+
+def rank_comments(comments: list[str], likes: dict[str, int] = None) -> list[str]:
+    # Лайки приходят по исходному тексту комментария - переносим их на очищенный до очистки.
+    likes = likes or {}
+    cleaned_likes = {}
+    for comment in comments:
+        if cleaned := clean_text(comment)[:_COMMENT_MAX_CHARS]:
+            cleaned_likes[cleaned] = max(cleaned_likes.get(cleaned, 0), likes.get(comment, 0))
+
+    return sorted(dedupe(list(cleaned_likes)), key=lambda comment: signal_score(comment, cleaned_likes[comment]),
+                  reverse=True)
+
+
+def build_summary(title: str, description: str | None, owner_comments: list[str], top_comments: list[str],
+                  likes: dict[str, int] = None, max_chars: int = 0) -> str:
+    """Собирает JSON для модели, укладываясь в max_chars (0 - без ограничения)."""
+    description = clean_text(description)
+    owner_comments = rank_comments(owner_comments, likes)
+    top_comments = [comment for comment in rank_comments(top_comments, likes) if comment not in owner_comments]
+
+    if not max_chars:
+        return _dump(title, description, owner_comments, top_comments)
+
+    reserved = description[:int(max_chars * _DESCRIPTION_SHARE)]
+    kept_owner, kept_top = [], []
+    for comments, kept in [(owner_comments, kept_owner), (top_comments, kept_top)]:
+        for comment in comments:
+            kept.append(comment)
+            if len(_dump(title, reserved, kept_owner, kept_top)) > max_chars:
+                kept.pop()
+                break
+
+    # Самый длинный префикс описания, который влезает рядом с оставленными комментариями.
+    low, high = len(reserved), len(description)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if len(_dump(title, description[:middle], kept_owner, kept_top)) <= max_chars:
+            low = middle
+        else:
+            high = middle - 1
+
+    return _dump(title, description[:low], kept_owner, kept_top)
+
+
+def _dump(title: str, description: str, owner_comments: list[str], top_comments: list[str]) -> str:
+    return json.dumps({
+        "title": title,
+        "description": description,
+        "owner_comments": owner_comments,
+        "top_comments": top_comments,
+    }, ensure_ascii=False)
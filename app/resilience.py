@@ -0,0 +1,163 @@
+import asyncio
+import inspect
+import random
+import time
+
+import aiohttp
+
+import log
+import metrics
+import throttling
+
+_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenException(aiohttp.ClientConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    _name: str
+    _threshold: int
+    _reset_timeout: float
+    _failures = 0
+    _opened_at: float | None = None
+    _probing = False
+
+    def __init__(self, name: str, threshold: int, reset_timeout: float):
+        self._name = name
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+
+    def allow(self) -> bool:
+        """Закрыт - пропускает всё; открыт - ничего; после reset_timeout пропускает одну пробную попытку."""
+        if self._threshold <= 0 or self._opened_at is None:
+            return True
+
+        if self._probing or time.monotonic() - self._opened_at < self._reset_timeout:
+            return False
+
+        self._probing = True
+        return True
+
+    def record_success(self):
+        if self._opened_at is not None:
+            log.info(f'circuit closed: {self._name}')
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self._failures += 1
+        if self._probing or (self._opened_at is None and self._failures >= self._threshold > 0):
+            if self._opened_at is None:
+                log.warning(f'circuit opened: {self._name}', self._failures)
+            self._opened_at = time.monotonic()
+        self._probing = False
+
+    def abandon(self):
+        self._probing = False
+
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+
+class Policy:
+    _name: str
+    _retries: int
+    _backoff: float
+    _max_backoff: float
+    _breaker_threshold: int
+    _breaker_reset_timeout: float
+    breaker: CircuitBreaker
+
+    def __init__(self, name: str, retries: int, backoff: float, max_backoff: float,
+                 breaker_threshold: int, breaker_reset_timeout: float):
+        self._name = name
+        self._retries = max(retries, 0)
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._breaker_threshold = breaker_threshold
+        self._breaker_reset_timeout = breaker_reset_timeout
+        self.breaker = CircuitBreaker(name, breaker_threshold, breaker_reset_timeout)
+
+    def fork(self, name: str, retries: int = None) -> 'Policy':
+        """Те же настройки, но свой автомат - для отдельного экземпляра апстрима."""
+        return Policy(name, self._retries if retries is None else retries, self._backoff, self._max_backoff,
+                      self._breaker_threshold, self._breaker_reset_timeout)
+
+    async def call(self, func, *args, limiter: throttling.TokenBucket = None, **kwargs):
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                metrics.inc('upstream_rejected_total', upstream=self._name)
+                raise CircuitOpenException(f'circuit open: {self._name}')
+
+            # Каждая попытка, включая повтор после 429, ждёт токен; ожидание не входит во время апстрима.
+            if limiter is not None:
+                await limiter.acquire_async()
+            started_at = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                self.breaker.abandon()
+                raise
+            except Exception as e:
+                metrics.observe('upstream_request_seconds', time.perf_counter() - started_at, upstream=self._name,
+                                outcome='error')
+                if not is_transient(e):
+                    self.breaker.record_success()
+                    raise
+
+                self.breaker.record_failure()
+                if attempt >= self._retries or self.breaker.is_open():
+                    raise
+
+                metrics.inc('upstream_retries_total', upstream=self._name)
+                await asyncio.sleep(self.delay(attempt, e))
+                attempt += 1
+                continue
+
+            metrics.observe('upstream_request_seconds', time.perf_counter() - started_at, upstream=self._name,
+                            outcome='ok')
+            self.breaker.record_success()
+            return result
+
+    def delay(self, attempt: int, error: Exception = None) -> float:
+        """Экспоненциальная пауза с полным джиттером; Retry-After апстрима имеет приоритет."""
+        if retry_after := _retry_after(error):
+            return min(retry_after, self._max_backoff)
+
+        return random.uniform(0, min(self._max_backoff, self._backoff * 2 ** attempt))
+
+
+def is_transient(error: BaseException) -> bool:
+    if isinstance(error, CircuitOpenException):
+        return False
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in _RETRYABLE_STATUSES
+
+    return isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError))
+
+
+def with_policy(policy: Policy, limiter: throttling.TokenBucket = None):
+    def decorator(func):
+        if not inspect.iscoroutinefunction(func):
+            raise TypeError(f'{func.__name__} must be a coroutine function')
+
+        async def wrapper(*args, **kwargs):
+            return await policy.call(func, *args, limiter=limiter, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _retry_after(error: Exception | None) -> float | None:
+    if not isinstance(error, aiohttp.ClientResponseError) or not error.headers:
+        return None
+
+    try:
+        return float(error.headers.get('Retry-After', ''))
+    except ValueError:
+        return None
@@ -0,0 +1,50 @@
+import asyncio
+
+import aiohttp
+
+
+class Pool:
+    _limit: int
+    _timeout: aiohttp.ClientTimeout
+    _keepalive_timeout: float
+    _session: aiohttp.ClientSession | None = None
+    _loop: asyncio.AbstractEventLoop | None = None
+
+    def __init__(self, limit: int, connect_timeout: float, read_timeout: float, keepalive_timeout: float,
+                 total_timeout: float = 0):
+        self._limit = limit
+        self._timeout = aiohttp.ClientTimeout(total=total_timeout or None, sock_connect=connect_timeout,
+                                              sock_read=read_timeout)
+        self._keepalive_timeout = keepalive_timeout
+
+    def session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is not None and self._loop is not loop:
+            _retire(self._session, self._loop)
+            self._session = None
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._limit, keepalive_timeout=self._keepalive_timeout),
+                timeout=self._timeout,
+            )
+            self._loop = loop
+
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._loop = None
+
+
+def _retire(session: aiohttp.ClientSession, loop: asyncio.AbstractEventLoop):
+    """Сессия привязана к своему event loop - закрываем её там же."""
+    if session.closed:
+        return
+
+    if loop.is_running():
+        asyncio.run_coroutine_threadsafe(session.close(), loop)
+    else:
+        # Закрыть асинхронно уже негде: соединения умерли вместе с loop, отвязываем их от сессии.
+        session.detach()
@@ -0,0 +1,287 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+from collections import Counter
+from dataclasses import dataclass
+
+import aiohttp
+from aiohttp import web
+
+import log
+
+UPSTREAM_YOUTUBE = 'youtube'
+UPSTREAM_AI = 'ai'
+UPSTREAM_KINOPOISK = 'kinopoisk'
+UPSTREAM_KARELIA_PRO = 'karelia_pro'
+UPSTREAMS = [UPSTREAM_YOUTUBE, UPSTREAM_AI, UPSTREAM_KINOPOISK, UPSTREAM_KARELIA_PRO]
+
+YOUTUBE_PREFIX = '/youtube/v3'
+_ROUTES = [
+    (UPSTREAM_YOUTUBE, 'GET', YOUTUBE_PREFIX + '/{section}'),
+    (UPSTREAM_AI, 'POST', '/v1/chat/completions'),
+    (UPSTREAM_KINOPOISK, 'GET', '/v1.4/movie/search'),
+    (UPSTREAM_KARELIA_PRO, 'GET', '/ajax/search/1'),
+]
+# Секреты не попадают ни в ключ фикстуры, ни в файл.
+_SECRET_PARAMS = {'key'}
+_HOP_BY_HOP_HEADERS = {'host', 'content-length', 'transfer-encoding', 'connection', 'accept-encoding'}
+_CHANNEL_ID = 'standin-channel'
+_KARELIA_PRO_SITES = {'1': 'movie', '2': 'tv-series', '3': 'anime', '5': 'cartoon'}
+
+
+@dataclass
+class Film:
+    id: int
+    name: str
+    year: int
+    type: str = 'movie'
+
+
+CATALOG = [
+    Film(1, 'Сёстры', 2021),
+    Film(2, 'Игра престолов', 2011, 'tv-series'),
+    Film(3, 'Крысиные бега', 2001),
+    Film(4, 'Гадкий я', 2010, 'cartoon'),
+    Film(5, 'Атака титанов', 2013, 'anime'),
+    Film(6, 'Никто', 2021),
+    Film(7, 'Американская семейка', 2009, 'tv-series'),
+    Film(8, 'Алиса в Пограничье', 2020, 'tv-series'),
+    Film(9, 'Шазам!', 2019),
+    Film(10, 'Интерстеллар', 2014),
+]
+
+
+def film_by_video_id(video_id: str) -> Film:
+    return CATALOG[int(hashlib.sha256(video_id.encode()).hexdigest(), 16) % len(CATALOG)]
+
+
+def fixture_key(upstream: str, method: str, path: str, query: dict, body: bytes) -> str:
+    query = sorted((name, value) for name, value in query.items() if name not in _SECRET_PARAMS)
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False) if body else ''
+    except ValueError:
+        body = body.decode(errors='replace')
+
+    request = json.dumps([upstream, method, path, query, body], ensure_ascii=False)
+    return hashlib.sha256(request.encode()).hexdigest()[:24]
+
+
+class StandIns:
+    """Подмена внешних сервисов: фикстуры с диска, запись промахов с настоящего апстрима, иначе синтетика."""
+    calls: Counter
+    _fixtures_path: str | None
+    _latency: dict[str, float]
+    _jitter: float
+    _record: dict[str, str]
+    _session: aiohttp.ClientSession | None = None
+
+    def __init__(self, fixtures_path: str = None, latency: dict[str, float] = None, jitter: float = 0,
+                 record: dict[str, str] = None):
+        self.calls = Counter()
+        self._fixtures_path = fixtures_path
+        self._latency = latency or {}
+        self._jitter = jitter
+        self._record = record or {}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        for upstream, method, path in _ROUTES:
+            app.router.add_route(method, path, self._handler(upstream))
+        app.on_cleanup.append(self._close)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> tuple[web.AppRunner, str]:
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        return runner, f'http://{host}:{port}'
+
+    def _handler(self, upstream: str):
+        async def handle(request: web.Request) -> web.StreamResponse:
+            self.calls[upstream] += 1
+            if delay := self._latency.get(upstream, 0):
+                await asyncio.sleep(delay * (1 + random.uniform(-self._jitter, self._jitter)))
+
+            body = await request.read()
+            path = request.path.removeprefix(YOUTUBE_PREFIX) if upstream == UPSTREAM_YOUTUBE else request.path
+            key = fixture_key(upstream, request.method, path, dict(request.query), body)
+            if fixture := self._load(upstream, key):
+                return _fixture_response(fixture)
+            if upstream in self._record:
+                return await self._record_response(upstream, key, request, path, body)
+
+            return await _SYNTHETIC[upstream](request, body)
+
+        return handle
+
+    def _load(self, upstream: str, key: str) -> dict | None:
+        if not self._fixtures_path or not os.path.exists(path := self._fixture_path(upstream, key)):
+            return None
+
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    async def _record_response(self, upstream: str, key: str, request: web.Request, path: str,
+                               body: bytes) -> web.Response:
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+
+        headers = {name: value for name, value in request.headers.items() if name.lower() not in _HOP_BY_HOP_HEADERS}
+        if upstream == UPSTREAM_KARELIA_PRO:
+            headers['Host'] = request.host
+        async with self._session.request(request.method, self._record[upstream] + path, params=request.query,
+                                         headers=headers, data=body or None, ssl=False) as response:
+            fixture = {
+                'request': {
+                    'method': request.method,
+                    'path': path,
+                    'query': {name: value for name, value in request.query.items() if name not in _SECRET_PARAMS},
+                    'body': body.decode(errors='replace'),
+                },
+                'status': response.status,
+                'content_type': response.content_type,
+                'body': await response.text(),
+            }
+
+        if self._fixtures_path and _is_recordable(response.status):
+            os.makedirs(os.path.dirname(path := self._fixture_path(upstream, key)), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(fixture, f, ensure_ascii=False, indent=2)
+            log.info(f'standins: recorded {upstream} {key}')
+
+        return _fixture_response(fixture)
+
+    def _fixture_path(self, upstream: str, key: str) -> str:
+        return os.path.join(self._fixtures_path, upstream, f'{key}.json')
+
+    async def _close(self, _app: web.Application):
+        if self._session is not None:
+            await self._session.close()
+
+
+def _is_recordable(status: int) -> bool:
+    """401, 429 и 5xx - состояние апстрима в момент записи, а не его ответ: в фикстуры они не попадают."""
+    return 200 <= status < 300 or status == 404
+
+
+def _fixture_response(fixture: dict) -> web.Response:
+    return web.Response(status=fixture['status'], text=fixture['body'], content_type=fixture['content_type'])
+
+
+async def _youtube(request: web.Request, _body: bytes) -> web.Response:
+    """Чётные по хешу видео называют фильм в заголовке (хватает эвристик), остальные - только в описании."""
+    if request.match_info['section'] == 'videos':
+        video_id = request.query.get('id', '')
+        film = film_by_video_id(video_id)
+        explicit = int(hashlib.md5(video_id.encode()).hexdigest(), 16) % 2 == 0
+        return web.json_response({'items': [{'snippet': {
+            'channelId': _CHANNEL_ID,
+            'title': f'Фильм: {film.name} ({film.year}) лучший момент' if explicit else 'Лучший момент',
+            'description': f'{film.name} — смотрите до конца\nhttps://example.com',
+        }}]})
+
+    film = film_by_video_id(request.query.get('videoId', ''))
+    comments = [(_CHANNEL_ID, f'{film.name} {film.year}', 10), ('viewer', 'Круто!', 3), ('viewer', 'Что за музыка?', 1)]
+    return web.json_response({'items': [{'snippet': {'topLevelComment': {'snippet': {
+        'textOriginal': text,
+        'authorChannelId': {'value': author},
+        'likeCount': likes,
+    }}}} for author, text, likes in comments]})
+
+
+async def _ai(request: web.Request, body: bytes) -> web.StreamResponse:
+    data = json.loads(body or b'{}')
+    prompt = ' '.join(str(message.get('content', '')) for message in data.get('messages', []))
+    film = next((film for film in CATALOG if film.name.lower() in prompt.lower()), None)
+    answer = f'{film.name} ({film.year})' if film else 'Не знаю'
+    if not data.get('stream'):
+        return web.json_response({'choices': [{'message': {'role': 'assistant', 'content': answer}}]})
+
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+    await response.prepare(request)
+    try:
+        for chunk in [answer[:len(answer) // 2], answer[len(answer) // 2:], '\n']:
+            await response.write(f'data: {json.dumps({"choices": [{"delta": {"content": chunk}}]})}\n\n'.encode())
+        await response.write(b'data: [DONE]\n\n')
+    except ConnectionResetError:
+        # Клиент дочитал ответ до конца строки и закрыл соединение - так и задумано.
+        pass
+    return response
+
+
+async def _kinopoisk(request: web.Request, _body: bytes) -> web.Response:
+    return web.json_response({'docs': [{
+        'id': film.id,
+        'name': film.name,
+        'alternativeName': '',
+        'enName': '',
+        'names': [],
+        'year': film.year,
+        'type': film.type,
+    } for film in _search(request.query.get('query', ''))]})
+
+
+async def _karelia_pro(request: web.Request, _body: bytes) -> web.Response:
+    _type = _KARELIA_PRO_SITES.get(request.query.get('site', ''))
+    return web.json_response({'videos': [{
+        'id': 1000 + film.id,
+        'kinopoiskId': film.id,
+        'title': film.name,
+    } for film in _search(request.query.get('query', '')) if film.type == _type or _type == 'movie']})
+
+
+def _search(query: str) -> list[Film]:
+    query = query.lower().strip()
+    return [film for film in CATALOG if query and (query in film.name.lower() or film.name.lower() in query)]
+
+
+_SYNTHETIC = {
+    UPSTREAM_YOUTUBE: _youtube,
+    UPSTREAM_AI: _ai,
+    UPSTREAM_KINOPOISK: _kinopoisk,
+    UPSTREAM_KARELIA_PRO: _karelia_pro,
+}
+
+
+def parse_upstream_values(value: str, _type=float) -> dict:
+    """Разбирает строку вида "ai=0.8,kinopoisk=0.1" в словарь по апстримам."""
+    values = {}
+    for item in filter(None, (value or '').split(',')):
+        upstream, _, item_value = item.partition('=')
+        if upstream not in UPSTREAMS:
+            raise argparse.ArgumentTypeError(f'unknown upstream {upstream}, expected one of {UPSTREAMS}')
+        values[upstream] = _type(item_value)
+
+    return values
+
+
+async def _serve(args: argparse.Namespace):
+    standins = StandIns(args.fixtures, parse_upstream_values(args.latency), args.jitter,
+                        parse_upstream_values(args.record, str))
+    runner, base_url = await standins.start(args.host, args.port)
+    log.info(f'standins listening on {base_url}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Локальные подмены YouTube, LLM, Кинопоиска и Karelia Pro.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--fixtures', help='каталог фикстур для воспроизведения и записи')
+    parser.add_argument('--latency', default='', help='задержка по апстримам, например ai=0.8,kinopoisk=0.1')
+    parser.add_argument('--jitter', type=float, default=0, help='разброс задержки, доля от 0 до 1')
+    parser.add_argument('--record', default='',
+                        help='записывать промахи с настоящих апстримов, например '
+                             'youtube=https://www.googleapis.com/youtube/v3,kinopoisk=https://api.kinopoisk.dev')
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
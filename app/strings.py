@@ -38,5 +38,11 @@ def clean_year(candidate):
     return re.sub(r' \(?\d+\)?', '', candidate)
 
 
+def extract_year(candidate: str) -> int | None:
+    if match := re.search(r'\((\d{4})\)', candidate):
+        return int(match.group(1))
+    return None
+
+
 def username_action(username: str, action: str) -> str:
     return f'[{username}]: {action}'
@@ -4,10 +4,12 @@ import uuid
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.types import Message
 
+import admission
 import core
+import metrics
 import strings
 
 dp = Dispatcher()
@@ -19,22 +21,40 @@ async def command_start_handler(message: Message) -> None:
     await message.answer(core.get_hello_message())
 
 
+@dp.message(Command('forget'))
+async def command_forget_handler(message: Message, command: CommandObject) -> None:
+    if not core.is_admin(message.from_user.id):
+        return
+
+    log.info(_mark_user_action(message, 'forget'), command.args)
+    await message.reply(core.forget_answer((command.args or '').strip()))
+
+
 @dp.message()
 async def echo_handler(message: Message) -> None:
     _id = str(uuid.uuid4())
+    timings = metrics.start_request()
     try:
         log.info(_mark_user_action(message, 'send'), _id, message)
         if _url := _extract_url(message):
-            answer, err = core.prepare_answer(_url, message.from_user.username, _id,
-                                              core.get_provider(message.from_user.id))
+            with metrics.span('total'):
+                async with core.admit(message.from_user.id):
+                    answer, err = await core.dispatch_answer(_url, message.from_user.username, _id,
+                                                             core.get_provider(message.from_user.id))
+            with metrics.span('reply'):
+                await message.reply(err or answer)
             if err:
-                await message.reply(err)
                 log.warning(_mark_user_action(message, err), _id)
             else:
-                await message.reply(answer)
                 log.info(_mark_user_action(message, answer), _id)
+    except admission.RejectedException as e:
+        # Отказ дешевле очереди: пользователь сразу узнаёт, что надо подождать.
+        log.warning(_mark_user_action(message, f'rejected {e.reason}'), _id)
+        await message.reply(core.get_busy_message())
     except Exception as e:
         log.exception(e, _id, message)
+    finally:
+        core.log_timings(message.from_user.username, _id, metrics.finish_request(timings))
 
 
 def _extract_url(message: Message) -> str | None:
@@ -49,10 +69,24 @@ def _mark_user_action(message: Message, action: str) -> str:
     return strings.username_action(message.from_user.username, action)
 
 
-async def start_polling() -> None:
-    telegram_bot_api = Bot(token=core.get_telegram_bot_token(),
-                           default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+def build_bot() -> Bot:
+    return Bot(token=core.get_telegram_bot_token(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+
+
+async def register_lifecycle() -> None:
+    if metrics_runner := await core.start_metrics():
+        dp.shutdown.register(metrics_runner.cleanup)
+    if workers_pool := await core.start_workers():
+        dp.shutdown.register(workers_pool.close)
+    core.start_sweeping()
+    dp.shutdown.register(core.stop_sweeping)
+    dp.shutdown.register(core.close)
     dp.shutdown.register(core.shutdown)
+
+
+async def start_polling() -> None:
+    telegram_bot_api = build_bot()
+    await register_lifecycle()
     await dp.start_polling(telegram_bot_api)
 
 
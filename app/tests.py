@@ -1,14 +1,42 @@
+import asyncio
 import copy
+import json
 import os
+import tempfile
+import time
+import traceback
 import uuid
 
+import aiohttp
+import aiohttp.web
+from aiogram import Bot, Dispatcher
+
+import admission
 import ai
+import answers
+import benchmark
 import config
 import core
 import strings
+import telegram
 import test_lib
+import throttling
+import titles
+import webhook
+import workers
+import youtube
 import serialize
+import standins
 import files
+import heuristics
+import karelia_pro
+import loadtest
+import matcher
+import metrics
+import persistence
+import prompts
+import resilience
+import sessions
 import cache
 from karelia_pro import Content
 from kinopoisk import Movie
@@ -23,12 +51,75 @@ def test_ai_normalize(before_normalization):
     return ai.normalize_answer(before_normalization)
 
 
+async def _stream_lines(chunks):
+    for chunk in chunks:
+        yield f'data: {json.dumps({"choices": [{"delta": {"content": chunk}}]})}\n'.encode()
+        yield b'\n'
+    yield b'data: [DONE]\n'
+
+
+@test_lib.assert_equals_cases([
+    [['Сёс', 'тры', ' (20', '21)', ' - это сериал'], ['Сёстры (2021)', 4]],
+    [['Сёстры', '\nОбъяснение', '...'], ['Сёстры', 2]],
+    [['Сёстры', ' (неопределён)'], ['Сёстры (неопределён)', 2]],
+])
+def test_ai_read_stream(chunks):
+    consumed = []
+
+    async def lines():
+        async for line in _stream_lines(chunks):
+            if line.startswith(b'data: {'):
+                consumed.append(line)
+            yield line
+
+    return [asyncio.run(ai._Api._read_stream(lines())), len(consumed)]
+
+
+def test_ai_route():
+    delays = {'slow': 0.5, 'fast': 0.01}
+
+    async def execute(base_url, request):
+        if base_url == 'down':
+            raise aiohttp.ClientConnectionError(base_url)
+        await asyncio.sleep(delays[base_url])
+        return base_url
+
+    async def route(api):
+        started_at = time.monotonic()
+        answer = await api._route({})
+        return answer, time.monotonic() - started_at
+
+    policy = resilience.Policy('ai', 0, 0, 0, 0, 0)
+    api = ai._Api(['slow', 'fast'], 'model', 0, 0, False, cache.Storage(), None, policy, 1, 50)
+    api._execute = execute
+    for _ in range(5):
+        api._backends[0]._latencies.append(0.02)
+    answer, elapsed = asyncio.run(route(api))
+    assert answer == 'fast' and elapsed < 0.2, (answer, elapsed)
+    assert [backend.base_url for backend in sorted(api._backends, key=ai._Backend.rank)] == ['fast', 'slow']
+
+    api = ai._Api(['down', 'fast'], 'model', 0, 0, False, cache.Storage(), None, policy)
+    api._execute = execute
+    assert asyncio.run(route(api))[0] == 'fast'
+    assert sorted(api._backends, key=ai._Backend.rank)[0].base_url == 'fast'
+
+    api = ai._Api(['fast', 'slow', 'spare'], 'model', 0, 0, False, cache.Storage(), None, policy, [1, 3])
+    assert [backend._concurrency for backend in api._backends] == [1, 3, 3]
+    api = ai._Api(['fast', 'slow'], 'model', 0, 0, False, cache.Storage(), None, policy, [1, 3])
+    api._execute = execute
+    fast, slow = api._backends
+    fast._latencies.extend([0.01] * 5)
+    slow._latencies.extend([0.5] * 5)
+    fast.in_flight = 1
+    assert asyncio.run(route(api))[0] == 'slow'
+
+
 @test_lib.assert_equals_cases([
     ['https://youtube.com/shorts/yFqdgT_224o?si=GYy5PkJdMneReVsR',
      ('Американская семейка (2009)\nhttps://www.kinopoisk.ru/film/472329', None)],
 ])
 def test_core_prepare_answer(url):
-    return core.prepare_answer(url, 'username', str(uuid.uuid4()))
+    return asyncio.run(core.prepare_answer(url, 'username', str(uuid.uuid4())))
 
 
 @test_lib.assert_equals_cases([
@@ -44,10 +135,114 @@ def test_core_prepare_answer(url):
     ['Атака титанов (2013)', ['Атака титанов (2013)', 100]],
 ])
 def test_core_approve_movie(candidate: str, fast_approve_threshold: int = config.MOVIE_HALF_APPROVE_THRESHOLD):
-    movie, score = core.approve_movie(candidate, fast_approve_threshold, str(uuid.uuid4()))
+    movie, score = asyncio.run(core.approve_movie(candidate, fast_approve_threshold, str(uuid.uuid4())))
     return movie.name_with_year(), score
 
 
+@test_lib.assert_equals_cases([
+    [[['Сёстры', 'Гадкий я'], 0], [[100, 100, 0], [13, 0, 100]]],
+    [[['Сёстры', 'Гадкий я'], 95], [[100, 100, 0], [0, 0, 100]]],
+    [[[], 0], []],
+])
+def test_matcher_matrix(data):
+    candidates, score_cutoff = data
+    return matcher.calculate_match_matrix(candidates, matcher.Choices(['Сёстры (2021)', 'СЕСТРЫ', 'Гадкий Я']),
+                                          score_cutoff)
+
+
+@test_lib.assert_equals_cases([
+    [['Сёстры', 1], [['Сёстры (2021)', 100, 0]]],
+    [['Гадкий я', 2], [['Гадкий Я', 100, 2], ['Сёстры (2021)', 13, 0]]],
+])
+def test_matcher_top_matches(data):
+    candidate, limit = data
+    return matcher.top_matches(candidate, ['Сёстры (2021)', 'СЕСТРЫ', 'Гадкий Я'], limit)
+
+
+@test_lib.assert_equals_cases([
+    ['Сёстры (2021)', [['Сёстры (2021)', 100], ['Сестра (2021)', 92], ['Сёстры (2017)', 92]]],
+    ['Сёстры (2017)', [['Сёстры (2017)', 100], ['Сёстры (2021)', 92], ['Сестра (2021)', 85]]],
+    ['Sisters', [['Сёстры (2017)', 100], ['Сестра (2021)', 0], ['Сёстры (2021)', 0]]],
+])
+def test_core_rank_kinopoisk_movies(candidate: str):
+    movies = [
+        Movie(3, ['Сестра'], 2021, Movie.TYPE_MOVIE),
+        Movie(2, ['Сёстры'], 2021, Movie.TYPE_TV_SERIES),
+        Movie(1, ['Сёстры', 'Sisters'], 2017, Movie.TYPE_MOVIE),
+        Movie(4, [], 2021, Movie.TYPE_MOVIE),
+    ]
+    return [[movie.name_with_year(), score] for movie, score in core.rank_kinopoisk_movies(candidate, movies)]
+
+
+def _titles_index() -> titles.Index:
+    index = titles.Index()
+    index.add([
+        Movie(1, ['Сёстры', 'Sisters'], 2017, Movie.TYPE_MOVIE),
+        Movie(2, ['Сёстры'], 2021, Movie.TYPE_TV_SERIES),
+        Movie(3, ['Гадкий я', 'Despicable Me'], 2010, Movie.TYPE_CARTOON),
+    ])
+    index.add_docs([{'id': 4, 'name': 'Атака титанов', 'enName': 'Attack on Titan', 'year': 2013, 'type': 'anime'}])
+    return index
+
+
+@test_lib.assert_equals_cases([
+    ['Сестры', [1, 2]],
+    ['despicable', [3]],
+    ['Атака титано', [4]],
+    ['Матрица', []],
+])
+def test_titles_index_search(candidate):
+    return sorted(movie.id for movie in _titles_index().search(candidate))
+
+
+def test_titles_index_skips_common_tokens():
+    max_postings, titles._MAX_POSTINGS = titles._MAX_POSTINGS, 2
+    try:
+        index = titles.Index()
+        index.add([Movie(i, [f'the {name}'], 2000) for i, name in enumerate(['night', 'day', 'war', 'road'])])
+        index.add([Movie(10, ['the night war'], 2001), Movie(11, ['the night war'], 2002)])
+        found = [sorted(movie.id for movie in index.search(candidate)) for candidate in ['the road', 'night war']]
+    finally:
+        titles._MAX_POSTINGS = max_postings
+    assert found == [[3], [10, 11]], found
+
+
+def test_matcher_calculate_similarities():
+    names = ['Кальмар: Игра', 'Игра', 'Ёлки']
+    assert matcher.calculate_similarities('игра', names) == [matcher.calculate_similarity('игра', n) for n in names]
+    assert matcher.calculate_similarities('елки', names, 95) == [0, 0, 100]
+
+
+@test_lib.assert_equals_cases([
+    ['Атака титанов (2013)', 4],
+    ['Атака титанов (2014)', None],
+    ['Атака титанов', None],
+    ['Игра (2019)', None],
+    ['Сестры (2021)', 2],
+])
+def test_core_get_indexed_movie(candidate):
+    index = _titles_index()
+    index.add([Movie(5, ['Кальмар: Игра'], 2019, Movie.TYPE_MOVIE)])
+    titles_index, core.titles_index = core.titles_index, index
+    try:
+        indexed = core.get_indexed_movie(candidate)
+    finally:
+        core.titles_index = titles_index
+    return indexed[0].id if indexed else None
+
+
+@test_lib.assert_equals_cases([
+    ['Игра (2019)', None],
+    ['Кальмар: игра (2019)', 5],
+    ['Кальмар: Игра (2020)', None],
+    ['Кальмар: Игра', None],
+])
+def test_core_approve_prefetched_movie(candidate):
+    movie = Movie(5, ['Кальмар: Игра'], 2019, Movie.TYPE_MOVIE)
+    approved = core.approve_prefetched_movie(candidate, [movie, movie, Movie(6, ['Игра'], 2007)])
+    return approved[0].id if approved else None
+
+
 @test_lib.assert_equals_cases([
     ['simple string', 'simple string'],
     [{'key': 'value'}, {'key': 'value'}],
@@ -59,20 +254,299 @@ def test_serialize(data):
     return serialize.deserialize_bytes(serialized)
 
 
+@test_lib.assert_equals_cases([
+    [[answers.Answer.OUTCOME_APPROVED, None, 'link'], config.ANSWER_CACHE_TTL_SECONDS],
+    [[answers.Answer.OUTCOME_APPROVED, None, None], config.ANSWER_CACHE_TTL_SECONDS],
+    [[answers.Answer.OUTCOME_APPROVED, core.karelia_pro.PROVIDER, 'link'], config.ANSWER_CACHE_TTL_SECONDS],
+    [[answers.Answer.OUTCOME_APPROVED, core.karelia_pro.PROVIDER, None], 0],
+    [[answers.Answer.OUTCOME_HALF_APPROVED, core.karelia_pro.PROVIDER, None], config.ANSWER_CACHE_TTL_SECONDS],
+    [[answers.Answer.OUTCOME_NOT_APPROVED, None, None], config.ANSWER_NOT_APPROVED_CACHE_TTL_SECONDS],
+])
+def test_core_answer_cache_ttl(data):
+    outcome, provider, provider_link = data
+    answer = answers.Answer(outcome, 'Сёстры', Movie(1, ['Сёстры'], 2021), 100, provider_link)
+    return core.answer_cache_ttl(answer, provider)
+
+
 def test_cache_stored():
-    storage = cache.Storage(name='tests')
+    storage = cache.Storage.restore(name='tests')
     key = 'key'
     data = {'key': 'value'}
     storage.put('key', data, 30)
-    file = files.build_storage_path(storage.name)
-    storage.archive()
+    storage.flush()
+    file = files.build_storage_path(storage.name, files.EXTENSION_SQLITE)
     assert os.path.exists(file)
     restored = cache.Storage.restore(name='tests')
-    assert restored.get(key) == data
+    assert asyncio.run(restored.get_async(key)) == data and len(restored) == 1
+    storage.archive()
+    restored.archive()
     os.remove(file)
     assert not os.path.exists(file)
 
 
+def test_cache_legacy_archive_migrated():
+    legacy = cache.Storage(name='tests')
+    legacy.put('key', 'value', 30)
+    legacy_file = files.build_storage_path(legacy.name)
+    files.save_file(legacy_file, serialize.serialize_bytes(legacy))
+    restored = cache.Storage.restore(name='tests')
+    restored.wait_restored()
+    assert restored.get('key') == 'value'
+    assert not os.path.exists(legacy_file)
+    restored.archive()
+    os.remove(files.build_storage_path(legacy.name, files.EXTENSION_SQLITE))
+
+
+def test_cache_legacy_archive_keeps_fresh_entries():
+    legacy = cache.Storage(name='tests')
+    legacy.put('key', 'stale', 30)
+    legacy_file = files.build_storage_path(legacy.name)
+    files.save_file(legacy_file, serialize.serialize_bytes(legacy))
+    backend = persistence.SqliteBackend(files.build_storage_path(legacy.name, files.EXTENSION_SQLITE))
+    backend.write('key', serialize.serialize_bytes('fresh'), None)
+    cache._migrate_legacy_archive(backend, legacy_file, legacy.name)
+    assert serialize.deserialize_bytes(backend.read('key')[0]) == 'fresh'
+
+    files.save_file(legacy_file, b'not a pickle')
+    cache._migrate_legacy_archive(backend, legacy_file, legacy.name)
+    assert not os.path.exists(legacy_file) and os.path.exists(f'{legacy_file}.corrupt')
+    os.remove(f'{legacy_file}.corrupt')
+    backend.close()
+    os.remove(files.build_storage_path(legacy.name, files.EXTENSION_SQLITE))
+
+
+def test_cache_lru_eviction():
+    storage = cache.Storage(name='tests', max_entries=2)
+    storage.put('a', 1)
+    storage.put('b', 2)
+    storage.get('a')
+    storage.put('c', 3)
+    assert [storage.get(key) for key in ['a', 'b', 'c']] == [1, None, 3]
+
+    storage = cache.Storage(name='tests', max_bytes=len(serialize.serialize_bytes('x' * 100)) * 2)
+    for key in ['a', 'b', 'c']:
+        storage.put(key, 'x' * 100)
+    assert len(storage) == 2 and storage.get('a') is None
+
+    storage = cache.Storage(name='tests')
+    storage.put('expired', 'data', -1)
+    assert storage.get('expired') is None and len(storage) == 0
+
+
+def test_cache_background_sweep():
+    storage = cache.Storage(name='tests', sweep_interval=0.01)
+
+    async def run():
+        storage.start_sweeping()
+        storage.put('expired', 'data', 0.01)
+        await asyncio.sleep(0.05)
+        swept = len(storage)
+        await storage.stop_sweeping()
+        return swept
+
+    assert asyncio.run(run()) == 0
+
+
+def test_cache_single_flight():
+    storage = cache.Storage(name='tests')
+    calls = []
+
+    @cache.with_cache(storage)
+    async def fetch(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value * 2
+
+    async def run():
+        return await asyncio.gather(*[fetch(value) for value in [1, 1, 1, 2, 2]])
+
+    assert asyncio.run(run()) == [2, 2, 2, 4, 4]
+    assert calls == [1, 2]
+
+
+def test_cache_negative():
+    storage = cache.Storage(name='tests', negative_ttls={ValueError: 60})
+    calls = []
+
+    @cache.with_cache(storage)
+    def fetch(error_class):
+        calls.append(error_class)
+        raise error_class('upstream failed')
+
+    for error_class in [ValueError, ValueError, KeyError, KeyError]:
+        try:
+            fetch(error_class)
+        except error_class:
+            pass
+
+    assert calls == [ValueError, KeyError, KeyError]
+
+    depths = []
+    for _ in range(3):
+        try:
+            fetch(ValueError)
+        except ValueError as e:
+            depths.append(len(traceback.extract_tb(e.__traceback__)))
+    assert depths[0] == depths[-1], depths
+
+    storage = cache.Storage(name='tests', negative_ttls=core._NEGATIVE_CACHE_TTLS,
+                            negative_filter=core._is_definitive_failure)
+    statuses = []
+
+    @cache.with_cache(storage)
+    def request(status):
+        statuses.append(status)
+        raise aiohttp.ClientResponseError(None, (), status=status)
+
+    for status in [404, 404, 503, 503, 401, 401, 429, 429]:
+        try:
+            request(status)
+        except aiohttp.ClientResponseError:
+            pass
+
+    assert statuses == [404, 503, 503, 401, 401, 429, 429], statuses
+
+
+def test_clients_survive_total_timeout():
+    async def handle(_request):
+        await asyncio.sleep(0.5)
+        return aiohttp.web.json_response({})
+
+    async def run():
+        app = aiohttp.web.Application()
+        app.router.add_get('/{tail:.*}', handle)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        host = '{}:{}'.format(*runner.addresses[0][:2])
+        policy = resilience.Policy('timeout', 0, 0, 0, 0, 0)
+        youtube_api = youtube.Api('key', f'http://{host}', throttling.TokenBucket(0), cache.Storage(name='tests'),
+                                  sessions.Pool(2, 1, 1, 10, 0.1), policy)
+        karelia_pro_api = karelia_pro.Api(cache.Storage(name='tests'), throttling.TokenBucket(0), host,
+                                          sessions.Pool(2, 1, 1, 10, 0.1), policy)
+        try:
+            return (await youtube_api.get_video_summary_by_id('video', 10, 'test'),
+                    await karelia_pro_api.movie_search('query', karelia_pro.Content.TYPE_VIDEO, 1))
+        finally:
+            await youtube_api.close()
+            await karelia_pro_api.close()
+            await runner.cleanup()
+
+    assert asyncio.run(run()) == (None, None)
+
+
+def test_karelia_pro_cache_hits_skip_limiter():
+    async def handle(_request):
+        return aiohttp.web.json_response({'videos': [{'id': 7, 'kinopoiskId': 1, 'title': 'Фильм'}]})
+
+    async def run():
+        app = aiohttp.web.Application()
+        app.router.add_get('/{tail:.*}', handle)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        api = karelia_pro.Api(cache.Storage(name='tests'), throttling.TokenBucket(1, 1, 'test'),
+                              '{}:{}'.format(*runner.addresses[0][:2]), sessions.Pool(2, 1, 1, 10),
+                              resilience.Policy('karelia_pro', 0, 0, 0, 0, 0))
+        try:
+            found = [await api.movie_search('query', karelia_pro.Content.TYPE_VIDEO, 1) for _ in range(3)]
+        finally:
+            await api.close()
+            await runner.cleanup()
+        return found
+
+    started_at = time.monotonic()
+    found = asyncio.run(run())
+    assert [content.id for content in found] == [7, 7, 7] and time.monotonic() - started_at < 0.5
+
+
+def test_youtube_comments_disabled_cached():
+    calls = []
+
+    async def handle(request):
+        calls.append(request.match_info['section'])
+        if request.match_info['section'] == 'videos':
+            return aiohttp.web.json_response({'items': [{'snippet': {'channelId': 'channel', 'title': 'title'}}]})
+        return aiohttp.web.json_response({'error': {'code': 403, 'errors': [{'reason': 'commentsDisabled'}]}},
+                                         status=403)
+
+    async def run():
+        app = aiohttp.web.Application()
+        app.router.add_get('/{section}', handle)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        api = youtube.Api('key', 'http://{}:{}'.format(*runner.addresses[0][:2]), throttling.TokenBucket(0),
+                          cache.Storage(name='tests'), sessions.Pool(2, 1, 1, 10),
+                          resilience.Policy('youtube', 0, 0, 0, 0, 0))
+        try:
+            return [await api.get_video_summary_by_id('video', 10, 'test') for _ in range(2)]
+        finally:
+            await api.close()
+            await runner.cleanup()
+
+    summaries = asyncio.run(run())
+    assert all(summary and summary.owner_comments == [] for summary in summaries)
+    assert calls == ['videos', 'commentThreads', 'commentThreads'], calls
+
+
+def test_cache_shared_between_workers():
+    first = cache.Storage.restore(name='tests', local_ttl=0.05)
+    second = cache.Storage.restore(name='tests', local_ttl=0.05)
+    first.put('key', 'value', 30)
+    first.flush()
+    assert second.get('key') == 'value'
+
+    first.delete('key')
+    first.flush()
+    assert second.get('key') == 'value'
+    time.sleep(0.06)
+    assert second.get('key') is None
+
+    first.archive()
+    second.archive()
+    os.remove(files.build_storage_path(first.name, files.EXTENSION_SQLITE))
+
+
+def test_workers_route():
+    pool = workers.Pool(4)
+    routes = {pool.route(f'https://youtu.be/video{i}') for i in range(50)}
+    assert routes == {0, 1, 2, 3}
+    assert pool.route('https://youtu.be/video1') == pool.route('https://www.youtube.com/watch?v=video1')
+
+
+def test_admission_queue():
+    queue = admission.Queue(max_concurrency=1, max_queue=3, user_in_flight=3, user_per_minute=4)
+    served = []
+    rejected = []
+
+    async def request(user, name):
+        try:
+            async with queue.slot(user):
+                served.append(name)
+                await asyncio.sleep(0.01)
+        except admission.RejectedException as e:
+            rejected.append((name, e.reason))
+
+    async def run():
+        tasks = []
+        for user, name in [(1, 'a'), (1, 'b'), (1, 'c'), (2, 'd'), (3, 'e'), (1, 'f')]:
+            tasks.append(asyncio.ensure_future(request(user, name)))
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        await request(1, 'g')
+        await request(1, 'h')
+
+    asyncio.run(run())
+    assert served == ['a', 'b', 'd', 'c', 'g'], served
+    assert rejected == [('e', admission.REASON_QUEUE_FULL), ('f', admission.REASON_USER_IN_FLIGHT),
+                        ('h', admission.REASON_RATE)], rejected
+    assert queue.running() == 0 and queue.queued() == 0
+
+
 def _test_cache_restore():
     storage = cache.Storage.restore(name='kinopoisk')
     assert storage is not None
@@ -97,10 +571,256 @@ def test_clean_year(candidate):
 ])
 def test_karelia_pro(data):
     candidate, _type, kp_id = data
-    actual = core.karelia_pro_api.movie_search(candidate, _type, kp_id)
+    actual = asyncio.run(core.karelia_pro_api.movie_search(candidate, _type, kp_id))
     return actual.link()
 
 
+@test_lib.assert_equals_cases([
+    [[2, 2, 4], [0, 0, 0.5, 1.0]],
+    [[1, 1, 3], [0, 1.0, 2.0]],
+    [[0, 1, 3], [0, 0, 0]],
+])
+def test_token_bucket_reserve(data):
+    rate, burst, calls = data
+    bucket = throttling.TokenBucket(rate, burst)
+    return [round(bucket._reserve(), 1) for _ in range(calls)]
+
+
+def test_sessions_pool_loop_change():
+    pool = sessions.Pool(2, 1, 1, 10, 5)
+
+    async def open_session():
+        return pool.session()
+
+    first = asyncio.run(open_session())
+    second = asyncio.run(open_session())
+    assert first is not second and first.closed and not second.closed
+    assert second.timeout.total == 5
+    asyncio.run(second.close())
+
+
+def test_resilience_policy():
+    calls = []
+
+    async def request(errors):
+        calls.append(len(errors))
+        if errors:
+            raise errors.pop(0)
+        return 'ok'
+
+    def response_error(status):
+        return aiohttp.ClientResponseError(None, (), status=status)
+
+    async def run(policy, errors):
+        try:
+            return await policy.call(request, errors)
+        except Exception as e:
+            return e.__class__.__name__
+
+    policy = resilience.Policy('test', 2, 0.001, 0.01, 3, 60)
+    assert asyncio.run(run(policy, [response_error(503), aiohttp.ServerDisconnectedError()])) == 'ok'
+    assert asyncio.run(run(policy, [response_error(404)])) == 'ClientResponseError'
+    assert len(calls) == 4, calls
+
+    assert asyncio.run(run(policy, [response_error(500)] * 5)) == 'ClientResponseError'
+    assert policy.breaker.is_open() and len(calls) == 7, calls
+    assert asyncio.run(run(policy, [])) == 'CircuitOpenException'
+    assert len(calls) == 7, calls
+
+    limiter = throttling.TokenBucket(1000, 1, 'test')
+    policy = resilience.Policy('test', 2, 0.001, 0.01, 3, 60)
+    reserved = []
+    reserve, limiter._reserve = limiter._reserve, lambda: reserved.append(1) or reserve()
+    assert asyncio.run(policy.call(request, [response_error(429)], limiter=limiter)) == 'ok'
+    assert len(reserved) == 2, reserved
+
+
+def test_metrics_render():
+    metrics.reset()
+    storage = cache.Storage(name='metrics-test')
+    storage.put('key', 'value')
+    storage.get('key')
+    storage.get('missing')
+
+    timings = metrics.start_request()
+    for stage in ['youtube', 'kinopoisk', 'kinopoisk']:
+        with metrics.span(stage):
+            pass
+    line = metrics.finish_request(timings)
+    assert line.startswith('youtube=0.000 kinopoisk=0.000x2'), line
+
+    rendered = metrics.render().splitlines()
+    assert 'cache_requests_total{result="hit",storage="metrics-test"} 1' in rendered, rendered
+    assert 'cache_requests_total{result="miss",storage="metrics-test"} 1' in rendered, rendered
+    assert 'stage_duration_seconds_count{stage="kinopoisk"} 2' in rendered, rendered
+    assert 'stage_duration_seconds_bucket{stage="kinopoisk",le="+Inf"} 2' in rendered, rendered
+
+
+def test_standins_record_replay():
+    async def run(fixtures_path):
+        upstream_runner, upstream_url = await standins.StandIns().start()
+        recorder = standins.StandIns(fixtures_path, record={standins.UPSTREAM_YOUTUBE: upstream_url + '/youtube/v3'})
+        recorder_runner, recorder_url = await recorder.start()
+        replayer = standins.StandIns(fixtures_path)
+        replayer_runner, replayer_url = await replayer.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                url = '/youtube/v3/videos?part=snippet&id=abc&key=secret'
+                async with session.get(recorder_url + url) as response:
+                    recorded = await response.json()
+                fixtures = os.listdir(os.path.join(fixtures_path, standins.UPSTREAM_YOUTUBE))
+                with open(os.path.join(fixtures_path, standins.UPSTREAM_YOUTUBE, fixtures[0]), encoding='utf-8') as f:
+                    fixture = f.read()
+                with open(os.path.join(fixtures_path, standins.UPSTREAM_YOUTUBE, fixtures[0]), 'w') as f:
+                    f.write(fixture.replace('standin-channel', 'fixture-channel'))
+                async with session.get(replayer_url + url.replace('secret', 'other')) as response:
+                    replayed = await response.json()
+        finally:
+            for runner in [upstream_runner, recorder_runner, replayer_runner]:
+                await runner.cleanup()
+
+        return recorded, replayed, fixture, replayer.calls
+
+    with tempfile.TemporaryDirectory() as fixtures_path:
+        recorded, replayed, fixture, calls = asyncio.run(run(fixtures_path))
+    assert 'secret' not in fixture
+    assert recorded['items'][0]['snippet']['channelId'] == 'standin-channel'
+    assert replayed['items'][0]['snippet']['channelId'] == 'fixture-channel'
+    assert calls == {standins.UPSTREAM_YOUTUBE: 1}
+    recordable = [standins._is_recordable(status) for status in [200, 204, 404, 401, 403, 429, 500]]
+    assert recordable == [True, True, True, False, False, False, False], recordable
+
+
+def test_loadtest_fake_session_streams_nothing():
+    async def stream():
+        return [chunk async for chunk in loadtest.FakeSession().stream_content('https://example.com/file')]
+
+    assert asyncio.run(stream()) == []
+
+
+def test_loadtest_update_has_url_entity():
+    link = 'https://youtu.be/load1'
+    update = loadtest.build_update(1, 1001, link)
+    assert telegram._extract_url(update.message) == link
+    assert update.message.from_user.username == 'load1001'
+
+
+def test_webhook_bounded_handler():
+    async def run():
+        dispatcher = Dispatcher()
+        release = asyncio.Event()
+        handled = []
+
+        @dispatcher.message()
+        async def handler(message):
+            handled.append(message.message_id)
+            await release.wait()
+
+        bot = Bot(token='42:WEBHOOK', session=loadtest.FakeSession())
+        runner = aiohttp.web.AppRunner(webhook.build_app(dispatcher, bot, '/hook', 'secret', 2))
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        url = 'http://{}:{}'.format(*runner.addresses[0][:2])
+        statuses = []
+        try:
+            async with aiohttp.ClientSession() as session:
+                for i, secret in enumerate(['wrong', 'secret', 'secret', 'secret']):
+                    update = loadtest.build_update(i, 1000 + i, 'https://youtu.be/hook')
+                    async with session.post(url + '/hook', data=update.model_dump_json(exclude_none=True),
+                                            headers={'X-Telegram-Bot-Api-Secret-Token': secret,
+                                                     'Content-Type': 'application/json'}) as response:
+                        statuses.append(response.status)
+                    await asyncio.sleep(0.05)
+                async with session.get(url + '/healthz') as response:
+                    health = await response.json()
+                release.set()
+                await asyncio.sleep(0.05)
+                async with session.get(url + '/healthz') as response:
+                    drained = await response.json()
+        finally:
+            await runner.cleanup()
+
+        return statuses, handled, health['in_flight'], drained['in_flight']
+
+    assert asyncio.run(run()) == ([401, 200, 200, 503], [1, 2], 2, 0)
+
+
+@test_lib.assert_equals_cases([
+    [[[], 50], 0],
+    [[[0.3, 0.1, 0.2], 50], 0.2],
+    [[list(range(1, 101)), 95], 95],
+    [[list(range(1, 101)), 99], 99],
+    [[[1, 2], 100], 2],
+])
+def test_benchmark_percentile(data):
+    values, percent = data
+    return benchmark.percentile(values, percent)
+
+
+@test_lib.assert_equals_cases([
+    [['Фильм: Сёстры (2021) лучший момент', '', []], ['Сёстры (2021)']],
+    [['Лучший момент из сериала «Игра престолов»', '', []], ['Игра престолов']],
+    [['Смешная сцена', 'Название фильма: Крысиные бега (2001)\nподписывайтесь', []], ['Крысиные бега (2001)']],
+    [['«Гадкий я» (2010) мультик', '', []], ['Гадкий я (2010)']],
+    [['Сцена', None, ['Фильм - Никто (2021). Приятного просмотра']], ['Никто (2021)']],
+    [['Котики смешные #shorts', 'ссылка https://example.com', ['спасибо за просмотр']], []],
+    [['Смешная сцена', 'Снято на отдыхе (2023)\nМосква (2022)', ['Лето (2021)']], []],
+    [['Сцена', None, ['Фильм - Никто. Приятного просмотра']], []],
+    [['Сцена', 'Фильмы - это жизнь\nОбзор: топ сериалов - Netflix', []], []],
+    [['Обзор: топ сериалов - Netflix', '', []], []],
+    [['Как снимали фильм "Титаник (1997)', '', []], []],
+])
+def test_heuristics_extract_candidates(data):
+    title, description, owner_comments = data
+    return heuristics.extract_candidates(youtube.VideoSummary('id', 'channel', title, description, owner_comments, []))
+
+
+def test_prompts_build_summary():
+    summary = json.loads(prompts.build_summary(
+        'Сцена "в кафе"',
+        'Смотрите https://example.com\n00:00 начало\n01:15 финал\nФильм из описания',
+        ['Фильм «Сёстры» (2021)'],
+        ['круто', 'Круто!', 'Это сериал «Сёстры»', 'лайк'],
+        {'лайк': 1000},
+    ))
+    assert summary == {
+        'title': 'Сцена "в кафе"',
+        'description': 'Смотрите\nФильм из описания',
+        'owner_comments': ['Фильм «Сёстры» (2021)'],
+        'top_comments': ['лайк', 'Это сериал «Сёстры»', 'круто'],
+    }, summary
+
+    limited = prompts.build_summary('title', 'description', [], ['comment'] * 3 + [str(i) * 50 for i in range(9)],
+                                    max_chars=200)
+    assert len(limited) <= 200 and json.loads(limited)['top_comments']
+
+    ranked = prompts.rank_comments(['круто', 'смотрите https://example.com', 'лайк'],
+                                   {'смотрите https://example.com': 1000, 'лайк': 10})
+    assert ranked == ['смотрите', 'лайк', 'круто'], ranked
+
+    limited = prompts.build_summary('title', 'описание "с кавычками"\n' * 20, [], ['comment'], max_chars=300)
+    assert len(limited) <= 300 and len(limited) > 290 and json.loads(limited)['top_comments'] == ['comment']
+
+
+def _comment_thread(*comments):
+    return {'items': [
+        {'snippet': {'topLevelComment': {'snippet': {'textOriginal': text, 'authorChannelId': {'value': owner}}}}}
+        for text, owner in comments
+    ]}
+
+
+@test_lib.assert_equals_cases([
+    [[_comment_thread(['first', 'owner']), 'owner', 2], [['first'], ['first']]],
+    [[_comment_thread(['first', 'user'], ['second', 'owner'], ['third', 'user']), 'owner', 2],
+     [['second'], ['first', 'second']]],
+    [[{}, 'owner', 2], [[], []]],
+])
+def test_youtube_comments_from_single_page(data):
+    thread, channel_id, max_comments = data
+    return youtube._filter_owner_comments(thread, channel_id), youtube._extract_comments(thread, max_comments)
+
+
 @test_lib.assert_equals_cases([
     ['6415316438', core.karelia_pro.PROVIDER],
     ['1054879386', core.karelia_pro.PROVIDER],
@@ -134,7 +854,7 @@ def test_map_content_types(kinopoisk_type):
 ])
 def test_build_with_provider(data):
     provider, movie = data
-    return core.build_with_provider_answer(provider, movie)[0]
+    return asyncio.run(core.build_with_provider_answer(provider, movie))[0]
 
 
 if __name__ == '__main__':
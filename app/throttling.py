@@ -1,32 +1,65 @@
+import asyncio
+import inspect
+import threading
 import time
 
+import metrics
 
-class RateLimiter:
-    _last_execute: float = 0
-    _executions: int = 0
-    _ttl = 0
 
-    def __init__(self, timeout_between_requests):
-        self._ttl = timeout_between_requests
+class TokenBucket:
+    _name: str
+    _rate: float
+    _burst: int
+    _tokens: float
+    _updated_at: float
+    _lock: threading.Lock
 
-    def touch(self):
-        self._last_execute = time.time()
-        self._executions += 1
+    def __init__(self, rate: float, burst: int = 1, name: str = 'limiter'):
+        self._name = name
+        self._rate = rate
+        self._burst = max(burst, 1)
+        self._tokens = self._burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
 
-    def wait(self):
-        from_last_request = time.time() - self._last_execute
-        if from_last_request < self._ttl:
-            time.sleep(self._ttl - from_last_request)
+    def acquire(self):
+        if delay := self._reserve():
+            time.sleep(delay)
+            metrics.observe('limiter_wait_seconds', delay, limiter=self._name)
 
+    async def acquire_async(self):
+        if delay := self._reserve():
+            await asyncio.sleep(delay)
+            metrics.observe('limiter_wait_seconds', delay, limiter=self._name)
 
-def with_limiter(limiter: RateLimiter):
+    def _reserve(self) -> float:
+        """Резервирует токен и возвращает время ожидания; долг в минус выстраивает вызовы в очередь FIFO."""
+        if self._rate <= 0:
+            return 0
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+
+            return -self._tokens / self._rate
+
+
+def with_limiter(limiter: TokenBucket):
     def decorator(func):
-        def wrapper(*args, **kwargs):
-            limiter.wait()
-            result = func(*args, **kwargs)
-            limiter.touch()
+        if inspect.iscoroutinefunction(func):
+            async def async_wrapper(*args, **kwargs):
+                await limiter.acquire_async()
+                return await func(*args, **kwargs)
+
+            return async_wrapper
 
-            return result
+        def wrapper(*args, **kwargs):
+            limiter.acquire()
+            return func(*args, **kwargs)
 
         return wrapper
 
@@ -0,0 +1,143 @@
+import json
+import logging
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+import files
+import kinopoisk
+import log
+import matcher
+import persistence
+import serialize
+
+_NGRAM_SIZE = 3
+_NGRAM_CANDIDATES = 20
+# Токен или n-грамма из большего числа названий (предлоги, частые слоги) поиск не сужает - их пропускаем.
+_MAX_POSTINGS = 2000
+_TOKEN_CANDIDATES = 200
+
+
+def normalize(value: str) -> str:
+    value = matcher.normalize(value)
+    return re.sub(r'\s+', ' ', re.sub(r'[^\w]+', ' ', value)).strip()
+
+
+def _tokens(value: str) -> set[str]:
+    return set(normalize(value).split())
+
+
+def _ngrams(value: str) -> set[str]:
+    padded = f' {normalize(value)} '
+    return {padded[i:i + _NGRAM_SIZE] for i in range(len(padded) - _NGRAM_SIZE + 1)}
+
+
+class Index:
+    _movies: dict[int, kinopoisk.Movie]
+    _by_token: dict[str, set[int]]
+    _by_ngram: dict[str, set[int]]
+    _backend: persistence.SqliteBackend | None
+    _lock: threading.Lock
+    _restoring: threading.Thread | None = None
+
+    def __init__(self, backend: persistence.SqliteBackend = None):
+        self._movies = {}
+        self._by_token = {}
+        self._by_ngram = {}
+        self._backend = backend
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def restore(name: str = 'titles') -> 'Index':
+        index = Index(persistence.SqliteBackend(files.build_storage_path(name, files.EXTENSION_SQLITE)))
+        index._restoring = threading.Thread(target=index._load, name=f'restore:{name}', daemon=True)
+        index._restoring.start()
+
+        return index
+
+    def wait_restored(self, timeout: float = None):
+        if self._restoring is not None:
+            self._restoring.join(timeout)
+
+    def add(self, movies: list[kinopoisk.Movie]):
+        added = [movie for movie in movies if self._index(movie)]
+        if added and self._backend:
+            self._backend.write_many([(str(movie.id), serialize.serialize_bytes(movie), None) for movie in added])
+
+    def add_docs(self, docs) -> int:
+        movies = [kinopoisk.parse_movie_data(movie_data) for movie_data in docs]
+        self.add(movies)
+
+        return len(movies)
+
+    def import_dump(self, path: str) -> int:
+        with open(path, encoding='utf-8') as f:
+            if path.endswith('.jsonl'):
+                return self.add_docs(json.loads(line) for line in f if line.strip())
+
+            data = json.load(f)
+            return self.add_docs(data.get('docs', []) if isinstance(data, dict) else data)
+
+    def search(self, candidate: str) -> list[kinopoisk.Movie]:
+        tokens = _tokens(candidate)
+        ngrams = _ngrams(candidate)
+        with self._lock:
+            ids = set()
+            # Сначала самые редкие токены: они точнее всего указывают на название.
+            for posting in sorted(_selective(self._by_token, tokens), key=len):
+                if len(ids) >= _TOKEN_CANDIDATES:
+                    break
+                ids |= posting
+            # Частые токены по отдельности бесполезны, но их пересечение ("игра" и "город") уже узкое.
+            common = sorted((self._by_token[token] for token in tokens
+                             if len(self._by_token.get(token, ())) > _MAX_POSTINGS), key=len)
+            if len(common) > 1 and len(shared := common[0].intersection(*common[1:])) <= _MAX_POSTINGS:
+                ids |= shared
+
+            overlap = Counter()
+            for posting in _selective(self._by_ngram, ngrams):
+                overlap.update(posting)
+            ids |= {_id for _id, _ in overlap.most_common(_NGRAM_CANDIDATES)}
+
+            return [self._movies[_id] for _id in ids]
+
+    def __len__(self):
+        return len(self._movies)
+
+    def _index(self, movie: kinopoisk.Movie) -> bool:
+        if movie.id is None or movie.id < 0 or not movie.names:
+            return False
+
+        with self._lock:
+            if (known := self._movies.get(movie.id)) is not None and known.names == movie.names:
+                return False
+
+            self._movies[movie.id] = movie
+            for name in movie.names:
+                for token in _tokens(name):
+                    self._by_token.setdefault(token, set()).add(movie.id)
+                for ngram in _ngrams(name):
+                    self._by_ngram.setdefault(ngram, set()).add(movie.id)
+
+        return True
+
+    def _load(self):
+        started_at = time.perf_counter()
+        for _, payload in self._backend.items():
+            self._index(serialize.deserialize_bytes(payload))
+
+        log.info(f'titles index restored {len(self)} movies in {(time.perf_counter() - started_at) * 1000:.1f} ms')
+
+
+def _selective(postings: dict[str, set[int]], keys: set[str]) -> list[set[int]]:
+    return [posting for key in keys if (posting := postings.get(key)) and len(posting) <= _MAX_POSTINGS]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    titles = Index.restore()
+    titles.wait_restored()
+    for dump in sys.argv[1:]:
+        log.info(f'titles index imported {titles.import_dump(dump)} movies from {dump}')
@@ -0,0 +1,103 @@
+import asyncio
+from typing import Any
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+import config
+import log
+import metrics
+import telegram
+
+MODE = 'webhook'
+_HEALTH_PATH = '/healthz'
+_RETRY_AFTER_SECONDS = 1
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Отвечает Telegram сразу и обрабатывает апдейт в фоне, но не больше max_in_flight одновременно.
+
+    Сверх лимита - 503: Telegram повторит доставку позже, возможно, на другую реплику за балансировщиком.
+    """
+    in_flight = 0
+    _max_in_flight: int
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str | None, max_in_flight: int, **data: Any):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self._max_in_flight = max_in_flight
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        if self._max_in_flight and self.in_flight >= self._max_in_flight:
+            metrics.inc('webhook_updates_total', result='rejected')
+            return web.Response(status=503, headers={'Retry-After': str(_RETRY_AFTER_SECONDS)})
+
+        self.in_flight += 1
+        try:
+            response = await super()._handle_request_background(bot, request)
+        except BaseException:
+            self.in_flight -= 1
+            raise
+
+        metrics.inc('webhook_updates_total', result='accepted')
+        return response
+
+    async def _background_feed_update(self, bot: Bot, update: dict[str, Any]) -> None:
+        try:
+            await super()._background_feed_update(bot, update)
+        finally:
+            self.in_flight -= 1
+
+    async def close(self) -> None:
+        # Сессию бота закрывает владелец приложения, а не обработчик запросов.
+        pass
+
+
+def build_app(dispatcher: Dispatcher, bot: Bot, path: str, secret_token: str | None,
+              max_in_flight: int) -> web.Application:
+    app = web.Application()
+    handler = BoundedRequestHandler(dispatcher, bot, secret_token, max_in_flight)
+    handler.register(app, path=path)
+
+    async def health(_request: web.Request) -> web.Response:
+        return web.json_response({'in_flight': handler.in_flight, 'max_in_flight': max_in_flight})
+
+    app.router.add_get(_HEALTH_PATH, health)
+    setup_application(app, dispatcher, bot=bot)
+    return app
+
+
+async def _set_webhook(bot: Bot) -> None:
+    await bot.set_webhook(
+        url=config.TELEGRAM_WEBHOOK_URL,
+        secret_token=config.TELEGRAM_WEBHOOK_SECRET,
+        max_connections=config.TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+    )
+    log.info(f'webhook set to {config.TELEGRAM_WEBHOOK_URL}')
+
+
+async def start() -> None:
+    bot = telegram.build_bot()
+    await telegram.register_lifecycle()
+    # Без публичного URL вебхук регистрируется снаружи: несколько реплик не должны его перезаписывать.
+    if config.TELEGRAM_WEBHOOK_URL:
+        telegram.dp.startup.register(_set_webhook)
+    if not config.TELEGRAM_WEBHOOK_SECRET:
+        log.warning('webhook secret token is not set, updates are not authenticated')
+    telegram.dp.shutdown.register(bot.session.close)
+
+    app = build_app(telegram.dp, bot, config.TELEGRAM_WEBHOOK_PATH, config.TELEGRAM_WEBHOOK_SECRET,
+                    config.TELEGRAM_WEBHOOK_MAX_IN_FLIGHT)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, config.TELEGRAM_WEBHOOK_HOST, config.TELEGRAM_WEBHOOK_PORT).start()
+    log.info(f'webhook listening on {config.TELEGRAM_WEBHOOK_HOST}:{config.TELEGRAM_WEBHOOK_PORT}'
+             f'{config.TELEGRAM_WEBHOOK_PATH}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(start())
@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+import multiprocessing
+from multiprocessing import queues
+import threading
+
+import log
+import metrics
+import youtube
+
+_STOP = None
+_WATCH_INTERVAL_SECONDS = 1
+_JOIN_TIMEOUT_SECONDS = 30
+# fork небезопасен при живых потоках (восстановление хранилищ, сборщик sqlite) - воркеры стартуют с чистого листа.
+_context = multiprocessing.get_context('spawn')
+
+
+class WorkerException(RuntimeError):
+    pass
+
+
+class _Worker:
+    index: int
+    jobs: queues.Queue
+    process: multiprocessing.Process
+
+    def __init__(self, index: int, jobs: queues.Queue, process: multiprocessing.Process):
+        self.index = index
+        self.jobs = jobs
+        self.process = process
+
+
+class Pool:
+    """Раздаёт prepare_answer процессам-воркерам; одно видео всегда попадает в один воркер, и single-flight работает."""
+    _size: int
+    _metrics_host: str
+    _metrics_port: int
+    _workers: list[_Worker]
+    _pending: dict[str, tuple[int, asyncio.Future]]
+    _results: queues.Queue | None = None
+    _reader: threading.Thread | None = None
+    _watchdog: asyncio.Task | None = None
+    _loop: asyncio.AbstractEventLoop | None = None
+
+    def __init__(self, size: int, metrics_host: str = '127.0.0.1', metrics_port: int = 0):
+        self._size = size
+        self._metrics_host = metrics_host
+        self._metrics_port = metrics_port
+        self._workers = []
+        self._pending = {}
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._results = _context.Queue()
+        self._workers = [self._spawn(index) for index in range(self._size)]
+        self._reader = threading.Thread(target=self._read_results, name='workers:results', daemon=True)
+        self._reader.start()
+        self._watchdog = asyncio.ensure_future(self._watch())
+        log.info(f'workers started {self._size} processes')
+
+    async def prepare_answer(self, link: str, username: str, _id: str,
+                             provider: str = None) -> tuple[str | None, str | None]:
+        worker = self._workers[self.route(link)]
+        future = self._loop.create_future()
+        self._pending[_id] = worker.index, future
+        worker.jobs.put((_id, link, username, provider))
+        try:
+            return await future
+        finally:
+            self._pending.pop(_id, None)
+
+    def route(self, link: str) -> int:
+        key = youtube.parse_video_id_by_link(link) or link
+        return int(hashlib.sha256(key.encode()).hexdigest(), 16) % self._size
+
+    async def close(self):
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+        for worker in self._workers:
+            worker.jobs.put(_STOP)
+        for worker in self._workers:
+            # Воркер дорабатывает принятые задания и архивирует хранилища.
+            await asyncio.to_thread(worker.process.join, _JOIN_TIMEOUT_SECONDS)
+            if worker.process.is_alive():
+                log.warning(f'worker {worker.index} did not stop in time')
+                worker.process.terminate()
+        if self._results is not None:
+            self._results.put(_STOP)
+
+    def _spawn(self, index: int) -> _Worker:
+        jobs = _context.Queue()
+        metrics_port = self._metrics_port + index + 1 if self._metrics_port else 0
+        process = _context.Process(target=_serve, args=(index, jobs, self._results, self._metrics_host, metrics_port),
+                                   name=f'worker-{index}', daemon=True)
+        process.start()
+        return _Worker(index, jobs, process)
+
+    def _read_results(self):
+        while (message := self._results.get()) is not _STOP:
+            self._loop.call_soon_threadsafe(self._resolve, *message)
+
+    def _resolve(self, _id: str, answer: tuple[str | None, str | None] | None, error: str | None):
+        if (pending := self._pending.get(_id)) is None or pending[1].done():
+            return
+
+        future = pending[1]
+        if error is not None:
+            future.set_exception(WorkerException(error))
+        else:
+            future.set_result(answer)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(_WATCH_INTERVAL_SECONDS)
+            for index, worker in enumerate(self._workers):
+                if worker.process.is_alive():
+                    continue
+
+                log.error(f'worker {index} exited with code {worker.process.exitcode}, restarting')
+                metrics.inc('worker_restarts_total', worker=index)
+                for worker_index, future in list(self._pending.values()):
+                    if worker_index == index and not future.done():
+                        future.set_exception(WorkerException(f'worker {index} exited'))
+                self._workers[index] = self._spawn(index)
+
+
+def _serve(index: int, jobs: queues.Queue, results: queues.Queue, metrics_host: str,
+           metrics_port: int):
+    try:
+        asyncio.run(_serve_jobs(index, jobs, results, metrics_host, metrics_port))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _serve_jobs(index: int, jobs: queues.Queue, results: queues.Queue, metrics_host: str,
+                      metrics_port: int):
+    # core собирает клиенты и открывает хранилища при импорте - в воркере это происходит уже после spawn.
+    import core
+
+    metrics_runner = await metrics.start_server(metrics_host, metrics_port) if metrics_port else None
+    core.start_sweeping()
+    tasks = set()
+    log.info(f'worker {index} ready')
+    try:
+        while (job := await asyncio.to_thread(jobs.get)) is not _STOP:
+            task = asyncio.ensure_future(_run_job(core, results, *job))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        if tasks:
+            await asyncio.wait(tasks)
+        await core.stop_sweeping()
+        await core.drain(_JOIN_TIMEOUT_SECONDS)
+        await core.close()
+        core.shutdown()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+
+async def _run_job(core, results: queues.Queue, _id: str, link: str, username: str, provider: str | None):
+    timings = metrics.start_request()
+    try:
+        results.put((_id, await core.prepare_answer(link, username, _id, provider), None))
+        metrics.inc('worker_jobs_total', result='ok')
+    except Exception as e:
+        log.exception(e, _id, link)
+        results.put((_id, None, f'{e.__class__.__name__}: {e}'))
+        metrics.inc('worker_jobs_total', result='error')
+    finally:
+        core.log_timings(username, _id, metrics.finish_request(timings))
@@ -1,19 +1,24 @@
+import asyncio
+import json
 import log
 import urllib.parse
 from typing import Generator
 
-import googleapiclient.discovery
-import googleapiclient.errors
+import aiohttp
 
 import cache
+import metrics
+import prompts
+import resilience
+import sessions
 import throttling
 
-_API_SERVICE_NAME = "youtube"
-_API_VERSION = "v3"
 _API_DOMAINS = ["youtube.com", "www.youtube.com", "youtu.be"]
 _API_SHORTS_PATH = "shorts"
 _API_WATCH_PATH = "watch"
 _API_WATCH_QUERY = "v"
+_API_COMMENTS_PAGE_SIZE = 100
+_API_COMMENTS_DISABLED = "commentsDisabled"
 
 
 def _is_youtube_link(parsed: urllib.parse.ParseResult) -> bool:
@@ -73,6 +78,35 @@ def _filter_owner_comments(_thread: dict, _chanel_id) -> list[str]:
     return _comments
 
 
+def _extract_comments(_thread: dict, max_comments: int) -> list[str]:
+    _comments = []
+    for item in _thread.get("items", []):
+        top_level_comment = item.get("snippet", {}).get("topLevelComment", {}).get("snippet", {})
+        if text := top_level_comment.get("textOriginal"):
+            _comments.append(text)
+
+    return _comments[:max_comments]
+
+
+def _is_comments_disabled(_body: str) -> bool:
+    try:
+        _errors = json.loads(_body).get("error", {}).get("errors", [])
+    except (ValueError, AttributeError):
+        return False
+
+    return any(error.get("reason") == _API_COMMENTS_DISABLED for error in _errors)
+
+
+def _extract_like_counts(_thread: dict) -> dict[str, int]:
+    _likes = {}
+    for item in _thread.get("items", []):
+        top_level_comment = item.get("snippet", {}).get("topLevelComment", {}).get("snippet", {})
+        if text := top_level_comment.get("textOriginal"):
+            _likes[text] = top_level_comment.get("likeCount", 0)
+
+    return _likes
+
+
 class VideoSummary:
     video_id: str
     chanel_id: str
@@ -80,13 +114,15 @@ class VideoSummary:
     description: str | None
     owner_comments: list[str]
     relevant_comments: list[str]
+    comment_likes: dict[str, int]
 
     def __init__(self, _video_id: str,
                  _chanel_id: str,
                  _title: str,
                  _description: str | None,
                  _owner_comments: list[str],
-                 _relevant_comments: list[str]
+                 _relevant_comments: list[str],
+                 _comment_likes: dict[str, int] = None
                  ):
         self.video_id = _video_id
         self.chanel_id = _chanel_id
@@ -94,31 +130,38 @@ class VideoSummary:
         self.description = _description
         self.owner_comments = _owner_comments
         self.relevant_comments = _relevant_comments
+        self.comment_likes = _comment_likes or {}
 
-    def json(self) -> str:
-        return f'''
-            "title": "{self.title}",
-            "description": "{self.description}",
-            "owner_comments": "{self.owner_comments}",
-            "top_comments": "{self.relevant_comments}",
-        '''
+    def json(self, max_chars: int = 0) -> str:
+        return prompts.build_summary(self.title, self.description, self.owner_comments, self.relevant_comments,
+                                     self.comment_likes, max_chars)
 
 
 class Api:
-    _youtube = None
+    _api_key = None
+    _base_url = None
     _limiter = None
     _storage = None
+    _pool = None
+    _policy = None
 
-    def __init__(self, api_key, limiter: throttling.RateLimiter, storage: cache.Storage):
-        self._youtube = googleapiclient.discovery.build(
-            _API_SERVICE_NAME, _API_VERSION, developerKey=api_key
-        )
+    def __init__(self, api_key, base_url: str, limiter: throttling.TokenBucket, storage: cache.Storage,
+                 pool: sessions.Pool, policy: resilience.Policy):
+        self._api_key = api_key
+        self._base_url = base_url
         self._limiter = limiter
         self._storage = storage
+        self._pool = pool
+        self._policy = policy
 
-    def get_video_summary_by_id(self, video_id: str, max_comments: int, _id: str) -> VideoSummary | None:
+    @metrics.timed('youtube')
+    async def get_video_summary_by_id(self, video_id: str, max_comments: int, _id: str) -> VideoSummary | None:
         try:
-            if not (video := self.parse_video_data(video_id, _id)):
+            video, thread = await asyncio.gather(
+                self.parse_video_data(video_id, _id),
+                self._fetch_comments(video_id, _API_COMMENTS_PAGE_SIZE, "relevance", _id),
+            )
+            if not video:
                 return None
 
             return VideoSummary(
@@ -126,91 +169,99 @@ class Api:
                 video.get("channelId", ""),
                 video.get("title", ""),
                 video.get("description", ""),
-                self.parse_owner_comments(video_id, video.get("channelId", ""), _id),
-                self.parse_video_comments(video_id, max_comments, _id)
+                await self.parse_owner_comments(video_id, video.get("channelId", ""), _id, thread),
+                await self.parse_video_comments(video_id, max_comments, _id, thread),
+                _extract_like_counts(thread)
             )
         except YoutubeException as e:
             log.exception(e, _id)
             return None
 
-    def parse_video_data(self, video_id: str, _id: str):
-        video = self._fetch_video(video_id)
+    async def parse_video_data(self, video_id: str, _id: str):
+        video = await self._fetch_video(video_id)
         for item in video.get("items", []):
             return item.get("snippet", None)
 
         return None
 
-    def parse_owner_comments(self, video_id, channel_id, _id: str, max_comments=100) -> list[str]:
-        comments = _filter_owner_comments(self._fetch_comments(video_id, max_comments, "relevance", _id), channel_id)
+    async def parse_owner_comments(self, video_id, channel_id, _id: str, relevant_thread: dict = None) -> list[str]:
+        if relevant_thread is None:
+            relevant_thread = await self._fetch_comments(video_id, _API_COMMENTS_PAGE_SIZE, "relevance", _id)
+        comments = _filter_owner_comments(relevant_thread, channel_id)
 
         if len(comments) == 0:
-            comments = _filter_owner_comments(self._fetch_comments(video_id, max_comments, "time", _id), channel_id)
+            comments = _filter_owner_comments(
+                await self._fetch_comments(video_id, _API_COMMENTS_PAGE_SIZE, "time", _id), channel_id)
 
         return comments
 
-    def parse_video_comments(self, video_id, max_comments, _id: str) -> list[str]:
-        comments = []
-        thread = self._fetch_comments(video_id, max_comments, "relevance", _id)
-        for item in thread.get("items", []):
-            top_level_comment = item.get("snippet", {}).get("topLevelComment", {}).get("snippet", {})
-            if text := top_level_comment.get("textOriginal"):
-                comments.append(text)
+    async def parse_video_comments(self, video_id, max_comments, _id: str, relevant_thread: dict = None) -> list[str]:
+        if relevant_thread is None:
+            relevant_thread = await self._fetch_comments(video_id, _API_COMMENTS_PAGE_SIZE, "relevance", _id)
 
-        return comments
+        return _extract_comments(relevant_thread, max_comments)
 
     def shutdown(self):
         self._storage.archive()
 
-    def _fetch_video(self, video_id: str) -> dict:
-        try:
-            return self._execute_list("videos",
-                                      part="snippet",
-                                      id=video_id)
-        except googleapiclient.errors.HttpError as e:
-            raise YoutubeException(e.reason, e.status_code)
+    async def close(self):
+        await self._pool.close()
 
-    def _fetch_comments(self, video_id: str, max_comments, order, _id: str) -> dict:
+    async def _fetch_video(self, video_id: str) -> dict:
+        try:
+            return await self._execute_list("videos",
+                                            part="snippet",
+                                            id=video_id)
+        except aiohttp.ClientResponseError as e:
+            raise YoutubeException(e.message, e.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise YoutubeException(str(e) or e.__class__.__name__, YoutubeException.CODE_UNAVAILABLE)
+
+    async def _fetch_comments(self, video_id: str, max_comments, order, _id: str) -> dict:
         try:
-            return self._execute_list("commentThreads",
-                                      part="snippet",
-                                      order=order,
-                                      videoId=video_id,
-                                      maxResults=max_comments)
-        except googleapiclient.errors.HttpError as e:
+            return await self._execute_list("commentThreads",
+                                            part="snippet",
+                                            order=order,
+                                            videoId=video_id,
+                                            maxResults=max_comments)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             log.exception(e, _id)
             return {}
 
-    def _fetch_owner_comments(self, video_id, channel_id, _id: str) -> dict:
+    async def _fetch_owner_comments(self, video_id, channel_id, _id: str) -> dict:
         try:
-            return self._execute_list("commentThreads",
-                                      part="snippet",
-                                      order="relevance",
-                                      videoId=video_id,
-                                      allThreadsRelatedToChannelId=channel_id)
-        except googleapiclient.errors.HttpError as e:
+            return await self._execute_list("commentThreads",
+                                            part="snippet",
+                                            order="relevance",
+                                            videoId=video_id,
+                                            allThreadsRelatedToChannelId=channel_id)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             log.exception(e, _id)
             return {}
 
-    def _execute_list(self, section, **kwargs):
+    async def _execute_list(self, section, **kwargs):
         @cache.with_cache(storage=self._storage)
-        def fetch_data(_section, **_kwargs):
-            request = getattr(self._youtube, _section)().list(
-                **_kwargs
-            )
-
-            return self._execute_request(request)
+        async def fetch_data(_section, **_kwargs):
+            return await self._execute_request(_section, _kwargs)
 
-        return fetch_data(section, **kwargs)
+        return await fetch_data(section, **kwargs)
 
-    def _execute_request(self, request) -> dict:
-        @throttling.with_limiter(limiter=self._limiter)
-        def execute(_request):
-            return _request.execute()
+    async def _execute_request(self, section: str, params: dict) -> dict:
+        @resilience.with_policy(policy=self._policy, limiter=self._limiter)
+        async def execute(_section, _params):
+            async with self._pool.session().get(f"{self._base_url}/{_section}",
+                                                params={**_params, "key": self._api_key}) as response:
+                # Отключённые комментарии - окончательный ответ: пустая ветка кэшируется, а не запрашивается заново.
+                if response.status == 403 and _is_comments_disabled(await response.text()):
+                    return {}
+                response.raise_for_status()
+                return await response.json(content_type=None)
 
-        return execute(request)
+        return await execute(section, params)
 
 
 class YoutubeException(Exception):
+    CODE_UNAVAILABLE = 503
     reason: str
     code: int
 